@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for CSView.
+
+Usage:
+    python3 benchmark.py [render] [startup] [stages] [logging] [width] [types] [writers] [--rows N] [--cols N] [--repeat N]
+
+Results are printed as JSON, with the best time of each case (in seconds) over the repeats.
+A benchmark can also report regressions (e.g. `startup` importing the pager stack); if any
+benchmark does, they are listed on stderr and the exit status is 1.
+"""
+
+import gc
+import io
+import math
+import os
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import unicodedata
+import importlib.util
+import tempfile
+import subprocess
+
+# Benchmark the colorized output, even when stdout isn't a terminal
+os.environ.setdefault("FORCE_COLOR", "1")
+
+import csview
+
+DEFAULT_ROWS = 20000
+DEFAULT_COLS = 20
+DEFAULT_REPEAT = 5
+CSVIEW_DIR = os.path.dirname(os.path.abspath(__file__))
+# Modules that only the interactive pager (or Windows) needs, which must not be imported at start-up
+LAZY_MODULES = ["pypager", "prompt_toolkit", "colorama", "multiprocessing"]
+# Shapes of the synthetic files of the `stages` benchmark: (number of columns, or None for --cols; kind of cells; comment header)
+SHAPES = {
+    "narrow": (4, "number", False),
+    "wide": (200, "number", False),
+    "long_cells": (None, "text", False),
+    "quoted": (None, "quoted", False),
+    "comments": (None, "number", True),
+    "unicode": (None, "unicode", False),
+}
+# How much slower measuring the columns may get from the debug logging in it, while debug output is off
+MAX_LOGGING_OVERHEAD = 0.2
+# How much slower measuring the columns may get from finding the numeric columns (see `NumericColumns`), for each
+# kind of column of `bench_types()`. Text is only checked until its first cell that isn't a number. Integers are
+# checked in one go, while signed decimals need a look at where their signs and points are.
+MAX_TYPES_OVERHEAD = {"number": 0.3, "decimal": 0.8, "text": 0.15, "mixed": 0.3}
+UNICODE_CHARS = "aéßøçЖжλπ日本語中文한국어😀"
+
+
+def best_time(func, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def make_rows(num_rows: int, num_cols: int, seed: int = 0) -> list[list[str]]:
+    rng = random.Random(seed)
+    return [[str(rng.randint(0, 10 ** rng.randint(1, 8))) for _ in range(num_cols)] for _ in range(num_rows)]
+
+
+def bench_render(num_rows: int, num_cols: int, repeat: int) -> dict:
+    """
+    Per-cell `colorize_row()` (one termcolor call per cell) vs. the precomputed templates of `RowRenderer`.
+    """
+    rows = make_rows(num_rows, num_cols)
+    max_widths: list[int] = list()
+    for row in rows:
+        csview.update_column_widths(max_widths, row)
+    separator = " "
+
+    def with_colorize_row():
+        for row in rows:
+            separator.join(csview.colorize_row(row, max_widths))
+
+    def with_row_renderer():
+        render = csview.RowRenderer(max_widths, separator).render
+        for row in rows:
+            render(row)
+
+    colorize_row_time = best_time(with_colorize_row, repeat)
+    row_renderer_time = best_time(with_row_renderer, repeat)
+    return {
+        "rows": num_rows,
+        "cols": num_cols,
+        "colorize_row": colorize_row_time,
+        "row_renderer": row_renderer_time,
+        "speedup": colorize_row_time / row_renderer_time,
+    }
+
+
+def bench_startup(num_rows: int, num_cols: int, repeat: int) -> dict:
+    """
+    Start-up cost: the import time of the csview module (from `python -X importtime`), and the wall time
+    of a whole `csview.py -p -n` run on a small file. Importing any of `LAZY_MODULES` is a regression.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import csview"], cwd=CSVIEW_DIR, capture_output=True, text=True, check=True)
+    # Lines look like "import time:  self [us] | cumulative | imported package", nested imports are indented
+    imported = dict()
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imported[fields[2].strip()] = int(fields[1])
+
+    rows = make_rows(min(num_rows, 100), num_cols)
+    with tempfile.NamedTemporaryFile("w", suffix=".csv") as csv_file:
+        csv_file.write("\n".join(",".join(row) for row in rows) + "\n")
+        csv_file.flush()
+        command = [sys.executable, os.path.join(CSVIEW_DIR, "csview.py"), "-p", "-n", csv_file.name]
+        print_time = best_time(lambda: subprocess.run(command, stdout=subprocess.DEVNULL, check=True), repeat)
+
+    return {
+        "import_csview": imported["csview"] / 1e6,
+        "print_small_file": print_time,
+        "regressions": [f"'{name}' is imported at start-up" for name in LAZY_MODULES if name in imported],
+    }
+
+
+def make_cell(rng: random.Random, kind: str) -> str:
+    if kind == "number":
+        return str(rng.randint(0, 10 ** rng.randint(1, 8)))
+    if kind == "text":
+        return "".join(rng.choices(string.ascii_letters + "     ", k=rng.randint(20, 80)))
+    if kind == "unicode":
+        return "".join(rng.choices(UNICODE_CHARS, k=rng.randint(2, 12)))
+    # Quoted fields with delimiters, escaped quotes and the odd line break
+    text = "".join(rng.choices(string.ascii_letters + ',  ""', k=rng.randint(5, 30)))
+    if rng.random() < 0.05:
+        text += "\n" + text
+    return '"' + text.replace('"', '""') + '"'
+
+
+def write_csv_file(path: str, shape: str, num_rows: int, num_cols: int, seed: int = 0) -> int:
+    """
+    Write a synthetic CSV file of one of the `SHAPES`, and return its size in bytes.
+    """
+    shape_cols, kind, comments = SHAPES[shape]
+    num_cols = shape_cols or num_cols
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8", newline="") as handle:
+        if comments:
+            handle.write("# Synthetic file for benchmark.py\n# generated with seed " + str(seed) + "\n")
+            handle.write("# " + ",".join(f"column_{i}" for i in range(num_cols)) + "\n")
+        for _ in range(num_rows):
+            handle.write(",".join(make_cell(rng, kind) for _ in range(num_cols)) + "\n")
+    return os.path.getsize(path)
+
+
+def bench_stages(num_rows: int, num_cols: int, repeat: int) -> dict:
+    """
+    Time each stage of showing a file, on synthetic files of every shape in `SHAPES` with num_rows / 100,
+    num_rows / 10 and num_rows rows: reading the raw lines (`read`), guessing the delimiter (`sniff_delimiter`),
+    measuring the columns (`scan_layout`), formatting every row (`format`), and building the pager source
+    and rendering its first screen (`pager_source`, None if the pager isn't installed).
+    """
+    has_pager = importlib.util.find_spec("pypager") is not None
+    if has_pager:
+        csview.import_pager()
+    results = dict()
+    with tempfile.TemporaryDirectory() as directory:
+        for shape in SHAPES:
+            results[shape] = dict()
+            for size in sorted({max(1, num_rows // 100), max(1, num_rows // 10), num_rows}):
+                path = os.path.join(directory, f"{shape}_{size}.csv")
+                file_bytes = write_csv_file(path, shape, size, num_cols)
+                csv_input = csview.CSVInput(path)
+                delimiter, _ = csview.sniff_delimiter(csv_input)
+                layout = csview.scan_layout(csv_input.raw_lines(), delimiter, csv_input.encoding)
+
+                def read():
+                    for _ in csv_input.raw_lines():
+                        pass
+
+                def format_rows():
+                    for _ in csview.iter_formatted_lines(csv_input.lines(), layout, " "):
+                        pass
+
+                def pager_source():
+                    source = csview.CSVPagerSource(csview.iter_formatted_lines(csv_input.lines(), layout, " "), shape)
+                    source.read_chunk()
+                    source.close()
+
+                results[shape][str(size)] = {
+                    "bytes": file_bytes,
+                    "read": best_time(read, repeat),
+                    "sniff_delimiter": best_time(lambda: csview.sniff_delimiter(csv_input), repeat),
+                    "scan_layout": best_time(lambda: csview.scan_layout(csv_input.raw_lines(), delimiter, csv_input.encoding), repeat),
+                    "format": best_time(format_rows, repeat),
+                    "pager_source": best_time(pager_source, repeat) if has_pager else None,
+                }
+                csv_input.close()
+    return results
+
+
+def bench_logging(num_rows: int, num_cols: int, repeat: int) -> dict:
+    """
+    Cost of debug logging on a hot path while debug output is off: `get_max_column_widths()` (which has
+    a debug message per row) vs. the same loop without any logging, and a debug message per row with its
+    values passed as arguments vs. formatted into an f-string. It's a regression if `get_max_column_widths()`
+    is more than `MAX_LOGGING_OVERHEAD` slower than the loop without logging.
+    """
+    csview.debug = False
+    lines = [",".join(row) for row in make_rows(num_rows, num_cols)]
+    logdbg = csview.logdbg
+
+    def no_logging():
+        widths: list[int] = list()
+        for row in list(csview.RowTokenizer(lines, ",")):
+            csview.update_column_widths(widths, row)
+
+    def lazy_messages():
+        widths: list[int] = list()
+        for rownum, row in enumerate(list(csview.RowTokenizer(lines, ","))):
+            logdbg("ROW %s: '%s'", rownum, row)
+            csview.update_column_widths(widths, row)
+
+    def eager_messages():
+        widths: list[int] = list()
+        for rownum, row in enumerate(list(csview.RowTokenizer(lines, ","))):
+            logdbg(f"ROW {rownum}: '{row}'")
+            csview.update_column_widths(widths, row)
+
+    no_logging_time = best_time(no_logging, repeat)
+    get_max_column_widths_time = best_time(lambda: csview.get_max_column_widths(lines, ","), repeat)
+    overhead = get_max_column_widths_time / no_logging_time - 1
+    return {
+        "rows": num_rows,
+        "cols": num_cols,
+        "no_logging": no_logging_time,
+        "get_max_column_widths": get_max_column_widths_time,
+        "overhead": overhead,
+        "lazy_messages": best_time(lazy_messages, repeat),
+        "eager_messages": best_time(eager_messages, repeat),
+        "regressions": [f"debug logging makes get_max_column_widths() {overhead:.0%} slower"] if overhead > MAX_LOGGING_OVERHEAD else [],
+    }
+
+
+def naive_display_width(text: str) -> int:
+    return sum(0 if unicodedata.combining(char) else 2 if unicodedata.east_asian_width(char) in ("W", "F") else 1 for char in text)
+
+
+def bench_width(num_rows: int, num_cols: int, repeat: int) -> dict:
+    """
+    Measuring the display width of cells: `len()` (wrong for wide and combining characters), `display_width()`
+    (ASCII fast path and lookup table) and a naive per-character `unicodedata` lookup, on ASCII and on Unicode cells.
+    """
+    rng = random.Random(0)
+    cells = {
+        "ascii": [make_cell(rng, "text") for _ in range(num_rows)],
+        "unicode": [make_cell(rng, "unicode") for _ in range(num_rows)],
+    }
+    results = {"cells": num_rows}
+    for kind, texts in cells.items():
+        results[kind] = {
+            "len": best_time(lambda: [len(text) for text in texts], repeat),
+            "display_width": best_time(lambda: [csview.display_width(text) for text in texts], repeat),
+            "unicodedata": best_time(lambda: [naive_display_width(text) for text in texts], repeat),
+        }
+    return results
+
+
+def bench_types(num_rows: int, num_cols: int, repeat: int) -> dict:
+    """
+    Cost of finding the numeric columns while measuring them: `scan_lines()` with and without `NumericColumns.update_columns()`,
+    on columns of numbers (every cell is classified), of text (cells are only classified until the first one that isn't
+    a number) and of both, plus measuring the decimal points of the numeric columns (`NumericColumns.measure_decimals()`),
+    and rendering the rows left-aligned, with the numeric columns right-aligned, and with their decimal points lined up.
+    It's a regression if the classification makes `scan_lines()` more than `MAX_TYPES_OVERHEAD` slower for a kind of column.
+    """
+    rng = random.Random(0)
+    kinds = {
+        "number": ["number"] * num_cols,
+        "decimal": ["decimal"] * num_cols,
+        "text": ["text"] * num_cols,
+        "mixed": ["number", "decimal", "text", "quoted"] * (num_cols // 4) + ["number"] * (num_cols % 4),
+    }
+
+    def make_typed_cell(kind: str) -> str:
+        if kind == "decimal":
+            return f"{rng.uniform(-1000, 1000):.{rng.randint(0, 6)}f}"
+        return make_cell(rng, kind)
+
+    update_columns = csview.NumericColumns.update_columns
+    results = {"rows": num_rows, "cols": num_cols}
+    regressions = list()
+    for name, column_kinds in kinds.items():
+        lines = [(",".join(make_typed_cell(kind) for kind in column_kinds) + "\n").encode() for _ in range(num_rows)]
+        # Runs with and without the classification take turns, so that both see the same load on the machine,
+        # and without the garbage collector, which would otherwise go through every row kept so far at random times
+        with_types_time = without_types_time = math.inf
+        gc.disable()
+        try:
+            for _ in range(repeat):
+                with_types_time = min(with_types_time, best_time(lambda: csview.scan_lines(lines, ","), 1))
+                csview.NumericColumns.update_columns = lambda self, columns, empty: None
+                try:
+                    without_types_time = min(without_types_time, best_time(lambda: csview.scan_lines(lines, ","), 1))
+                finally:
+                    csview.NumericColumns.update_columns = update_columns
+        finally:
+            gc.enable()
+        overhead = with_types_time / without_types_time - 1
+        if overhead > MAX_TYPES_OVERHEAD[name]:
+            regressions.append(f"finding numeric columns makes scan_lines() {overhead:.0%} slower on {name} columns")
+
+        layout = csview.scan_lines(lines, ",")
+        rows = list(csview.RowTokenizer(lines, ","))
+        measure_time = best_time(lambda: csview.NumericColumns.from_dict(layout.numeric_columns.to_dict()).measure_decimals(rows), repeat)
+        render_times = dict()
+        for alignment, numeric_columns, align_decimals in (("left", None, False), ("right", layout.numeric_columns, False), ("decimal", layout.numeric_columns, True)):
+            if align_decimals:
+                layout.align_decimals(rows)
+            render = csview.RowRenderer(layout.max_widths, " ", numeric_columns=numeric_columns, align_decimals=align_decimals).render
+            render_times[alignment] = best_time(lambda: [render(row) for row in rows], repeat)
+        results[name] = {
+            "numeric_columns": sum(layout.numeric_columns.numeric()),
+            "scan_without_types": without_types_time,
+            "scan_with_types": with_types_time,
+            "overhead": overhead,
+            "overhead_per_cell_ns": (with_types_time - without_types_time) / (num_rows * len(column_kinds)) * 1e9,
+            "measure_decimals": measure_time,
+            "render": render_times,
+        }
+    results["regressions"] = regressions
+    return results
+
+
+def bench_writers(num_rows: int, num_cols: int, repeat: int) -> dict:
+    """
+    Time of writing the rows with each of the `OUTPUT_WRITERS`, compared with joining the lines of the table.
+    It's a regression if a line break in a quoted field doesn't come out of JSON Lines as "\\n" and of Markdown
+    as "<br>", or splits a row of the table.
+    """
+    rows = make_rows(num_rows, num_cols)
+    max_widths: list[int] = list()
+    for row in rows:
+        csview.update_column_widths(max_widths, row)
+    header = [f"column {i + 1}" for i in range(num_cols)]
+    render = csview.RowRenderer(max_widths, " ", plain_text=True).render
+    results = {
+        "rows": num_rows,
+        "cols": num_cols,
+        "table_join": best_time(lambda: "\n".join([render(row) for row in rows]), repeat),
+    }
+    for output_format, writer_class in csview.OUTPUT_WRITERS.items():
+        results[output_format] = best_time(lambda: writer_class(io.StringIO(), max_widths, header).write(rows), repeat)
+
+    regressions = list()
+    lines = ["#a,b", '1,"x', 'y"', "2,z"]
+    layout = csview.scan_layout(lines, ",", keep_rows=True)
+    expected = {csview.OUTPUT_JSONL: '"b": "x\\ny"', csview.OUTPUT_MARKDOWN: "| x<br>y |"}
+    for output_format, text in expected.items():
+        output = io.StringIO()
+        csview.write_layout(lines, layout, output_format, output)
+        if text not in output.getvalue():
+            regressions.append(f"{output_format} output of a quoted line break has no {text}: {output.getvalue()!r}")
+    table = list(csview.iter_formatted_lines(lines, layout, plain_text=True))
+    if len(table) != 3 or any("\n" in line for line in table):
+        regressions.append(f"a quoted line break splits a row of the table: {table!r}")
+    results["regressions"] = regressions
+    return results
+
+
+BENCHMARKS = {
+    "render": bench_render,
+    "startup": bench_startup,
+    "stages": bench_stages,
+    "logging": bench_logging,
+    "width": bench_width,
+    "types": bench_types,
+    "writers": bench_writers,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run CSView microbenchmarks.")
+    parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS), help=f"Benchmarks to run, any of: {', '.join(BENCHMARKS)} (Default: all).")
+    parser.add_argument('--rows', type=int, default=DEFAULT_ROWS, help=f"Number of rows (Default: {DEFAULT_ROWS}).")
+    parser.add_argument('--cols', type=int, default=DEFAULT_COLS, help=f"Number of columns (Default: {DEFAULT_COLS}).")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help=f"Number of times to run each case (Default: {DEFAULT_REPEAT}).")
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if len(unknown) > 0:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    results = {name: BENCHMARKS[name](args.rows, args.cols, args.repeat) for name in args.benchmarks}
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    regressions = [f"{name}: {regression}" for name, result in results.items() for regression in result.get("regressions", [])]
+    for regression in regressions:
+        print(f"REGRESSION: {regression}", file=sys.stderr)
+    if len(regressions) > 0:
+        sys.exit(1)
@@ -5,6 +5,26 @@ import os
 import csv
 import traceback
 import re
+import stat
+import io
+import tempfile
+import mmap
+import itertools
+import hashlib
+import zlib
+import math
+import unicodedata
+import bisect
+import heapq
+import pickle
+import shutil
+import json
+import random
+import time
+import threading
+import contextlib
+from collections import Counter, deque
+from json.encoder import encode_basestring_ascii as encode_json_string
 # import pandas as pd
 
 RED = '\033[91m'
@@ -16,22 +36,31 @@ NOITALIC = '\033[23m'
 NOUL = '\033[24m'
 NC = '\033[0m'
 
+
+
+def exit_missing_packages(e: ImportError):
+    print(f"{RED}{UL}ERROR:{NOUL} {str(e)}{NC}", file=sys.stderr)
+    print(f"{RED}{UL}STACK TRACE:{NOUL} {traceback.format_exc()}{NC}", file=sys.stderr)
+    print(f"{RED}One or more required Python packages are not installed, run the install script or 'pip install -r requirements.txt'{NC}", file=sys.stderr)
+    sys.exit(1)
+
+
+# The pager stack (pypager, prompt_toolkit) and colorama are slow to import and only needed for
+# the interactive pager and on Windows, see `import_pager()` and `init_colors()`
 try:
     import argparse
     from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
     import ntpath
-    from typing import Any, AnyStr, Union, Type
-    from collections.abc import Generator
+    from typing import Any, AnyStr, Union, Type, BinaryIO, TextIO
+    from collections.abc import Generator, Iterable, Callable
     from termcolor import colored, cprint
-    import colorama
-    from pypager.source import StringSource, FormattedTextSource
-    from pypager.pager import Pager
-    from prompt_toolkit import ANSI
 except ImportError as e:
-    print(f"{RED}{UL}ERROR:{NOUL} {str(e)}{NC}", file=sys.stderr)
-    print(f"{RED}{UL}STACK TRACE:{NOUL} {traceback.format_exc()}{NC}", file=sys.stderr)
-    print(f"{RED}One or more required Python packages are not installed, run the install script or 'pip install -r requirements.txt'{NC}", file=sys.stderr)
-    sys.exit(1)
+    exit_missing_packages(e)
+
+Pager = None
+ANSI = None
+to_formatted_text = None
+explode_text_fragments = None
 
 PROGRAM_TITLE = "CSView"
 PROGRAM_NAME = PROGRAM_TITLE.lower()
@@ -45,6 +74,57 @@ DEFAULT_BOLD = False
 DEFAULT_PLAIN_TEXT = False
 DEFAULT_QUOTE_EMPTY = False
 DEFAULT_HIDE_TITLE = False
+DEFAULT_ENCODING = "utf-8"
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_SNIFF_BYTES = 64 * 1024
+DEFAULT_SNIFF_SAMPLES = 0
+DEFAULT_PAGER_CHUNK_LINES = 100
+DEFAULT_FAST_START_ROWS = 2000
+DEFAULT_FOLLOW_INTERVAL = 0.5
+DEFAULT_JOBS = 1
+DEFAULT_JOB_CHUNK_ROWS = 5000
+DEFAULT_PARALLEL_SCAN_BYTES = 8 * 1024 * 1024
+DEFAULT_PARALLEL_FORMAT_BYTES = 32 * 1024 * 1024
+DEFAULT_KEEP_ROWS_BYTES = 4 * 1024 * 1024
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "csview")
+DEFAULT_CACHE_BYTES = 32 * 1024 * 1024
+DEFAULT_CACHE_MIN_BYTES = 1024 * 1024
+DEFAULT_USE_CACHE = True
+DEFAULT_INDEX_ROWS = 1000
+DEFAULT_FROZEN_COLUMNS = 0
+# Bytes of input to sort in memory at a time (tokenized rows take up about ten times as much memory)
+DEFAULT_SORT_MEMORY_BYTES = 8 * 1024 * 1024
+DEFAULT_SORT_SPILL_BATCH_ROWS = 1000
+# Rows the first pass classifies and summarizes at a time (see `NumericColumns` and `ColumnStats`)
+DEFAULT_BATCH_ROWS = 1000
+# Distinct values are counted with 2 ** DEFAULT_DISTINCT_PRECISION bytes per column, to within about 1.6%
+DEFAULT_DISTINCT_PRECISION = 12
+# Values counted as missing by --stats (compared in lower case, without surrounding whitespace)
+NULL_VALUES = frozenset(["", "null", "none", "na", "n/a", "nan"])
+STATS_COLUMNS = ["column", "type", "values", "nulls", "distinct", "min", "max"]
+DEFAULT_STATS_VALUE_WIDTH = 40
+INDEX_FILE_SUFFIX = ".csvidx"
+# Magic bytes at the start of compressed input, and the compression they stand for
+COMPRESSION_MAGIC = {
+    b"\x1f\x8b": "gzip",
+    b"BZh": "bz2",
+    b"\xfd7zXZ\x00": "xz",
+    b"\x28\xb5\x2f\xfd": "zstd",
+}
+OVERFLOW_TRUNCATE = "truncate"
+OVERFLOW_WIDEN = "widen"
+OVERFLOW_MARKER = "…"
+# Shown in place of the line breaks in quoted fields, which would split a row of the table
+NEWLINE_MARKER = "↵"
+SELECT_HEAD = "head"
+SELECT_TAIL = "tail"
+SELECT_SAMPLE = "sample"
+# Output formats, see `OUTPUT_WRITERS` for the ones other than the (colorized) table
+OUTPUT_TABLE = "table"
+OUTPUT_MARKDOWN = "markdown"
+OUTPUT_FIXED = "fixed"
+OUTPUT_JSONL = "jsonl"
+COMMENT_CHAR = "#"
 COLOR_TITLE_TEXT = "light_grey"
 COLOR_TITLE_BG = "on_light_grey"
 COLOR_COMMAND = "light_blue"
@@ -73,7 +153,6 @@ COLOR_DESCRIPTION = "yellow"
 #
 # Available attributes:
 #     bold, dark, underline, blink, reverse, concealed.
-colorama.init()
 # colors = ['red', 'green', 'yellow', 'blue', 'magenta', 'cyan', 'white', 'grey', 'light_red', 'light_green']
 colors = ['red', 'light_green', 'yellow', 'blue', 'magenta', 'cyan', 'light_red', 'yellow', 'light_cyan', 'white']
 color_comment = "dark_grey"
@@ -84,18 +163,56 @@ color_error = "red"
 color_warning = "yellow"
 
 
+def import_pager():
+    """
+    Import the modules needed by the interactive pager, the first time it's called.
+    Importing them takes most of the start-up time, so output that doesn't go to the pager never does it.
+    """
+    global Pager, ANSI, to_formatted_text, explode_text_fragments
+    if Pager is not None:
+        return
+    try:
+        from pypager.pager import Pager
+        from prompt_toolkit import ANSI
+        from prompt_toolkit.formatted_text import to_formatted_text
+        from prompt_toolkit.layout.utils import explode_text_fragments
+    except ImportError as e:
+        exit_missing_packages(e)
+
+
+def init_colors():
+    """
+    Make ANSI colors work in the Windows console. Not needed anywhere else, so colorama isn't even imported there.
+    """
+    if sys.platform != "win32":
+        return
+    try:
+        import colorama
+    except ImportError as e:
+        exit_missing_packages(e)
+    colorama.init()
+
+
 def log(*args, **kwargs):
     print(" ".join(map(str, args)), **kwargs)
 
 
-def logdbg(*args, **kwargs):
+def logdbg(message: str, *args, **kwargs):
+    """
+    Print a debug message, if debug output is on. Like `logging`, the message is only formatted (`message % args`)
+    when it is printed, so the values should be passed as `args` rather than formatted into an f-string. Then a call
+    costs next to nothing when debug output is off, however big the values are; loops over rows should still check
+    `debug` first, to skip the calls altogether.
+    """
     global debug
     global color_debug
+    if not debug:
+        return
     label = "DEBUG"
     label_color = color_debug
-    output_debug = debug
-    if output_debug:
-        print(colored(f"[{label}]", label_color), " ".join(map(str, args)), **kwargs, file=sys.stderr)
+    if len(args) > 0:
+        message = message % args
+    print(colored(f"[{label}]", label_color), message, **kwargs, file=sys.stderr)
 
 
 def logerr(*args, **kwargs):
@@ -193,6 +310,262 @@ def get_file_contents(filename: str) -> str:
     return file_contents
 
 
+def detect_compression(header: bytes) -> Union[str, None]:
+    """
+    Return the compression format ("gzip", "bz2", "xz" or "zstd") that the first bytes of an input belong to,
+    or None if they don't look compressed.
+    """
+    for magic, compression in COMPRESSION_MAGIC.items():
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def open_decompressed(source: Union[str, BinaryIO], compression: str) -> BinaryIO:
+    """
+    Open a file (by name) or a binary stream compressed with `compression` (see `detect_compression()`),
+    as a stream of the decompressed data. Data is decompressed as it's read, a chunk at a time.
+    The decompression modules are only imported when they are needed. Reading zstd needs Python 3.14
+    or the `zstandard` package.
+    """
+    if compression == "gzip":
+        import gzip
+        return gzip.open(source, 'rb')
+    if compression == "bz2":
+        import bz2
+        return bz2.open(source, 'rb')
+    if compression == "xz":
+        import lzma
+        return lzma.open(source, 'rb')
+    if compression == "zstd":
+        try:
+            from compression import zstd
+            return zstd.open(source, 'rb')
+        except ImportError:
+            pass
+        try:
+            import zstandard
+        except ImportError as e:
+            alert = f"open_decompressed: reading zstd compressed input needs Python 3.14 or the 'zstandard' package ('pip install zstandard'): {e}"
+            logerr(alert)
+            raise TypeError(alert)
+        # Its reader can't be read line by line on its own
+        return io.BufferedReader(zstandard.open(source, 'rb'))
+    alert = f"open_decompressed: unknown compression '{compression}'"
+    logerr(alert)
+    raise TypeError(alert)
+
+
+class CSVInput:
+    """
+    Re-readable, line-oriented view of a CSV/TSV input, used by the two-pass formatter.
+
+    Regular files are memory-mapped (or re-opened and read in chunks, if mapping is disabled
+    or not possible) for every pass. Anything that cannot be re-read (stdin, pipes, /dev/stdin)
+    is copied into a temporary spool file while it is read, and later passes replay the spool
+    before reading any more from the input (so a pass that stops early, like the sample taken by
+    the fast-start mode, doesn't force the whole input to be read). Only one pass at a time may
+    read non-seekable input. Either way, the input is never held in memory as a whole.
+
+    Compressed input (gzip, bz2, xz or zstd, recognized by its first bytes, whether it's a file or
+    a stream) is decompressed as it's read, and treated like non-seekable input: the decompressed
+    data is spooled, so it's only decompressed once however many passes read it. Offsets (e.g. in
+    a row index) are offsets in the decompressed data.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the input file. Ignored if `stream` is provided.
+    stream : BinaryIO
+        Already-open binary stream to read from (e.g. `sys.stdin.buffer`).
+    chunk_size : int
+        Number of bytes to read from the input at a time.
+    encoding : str
+        Text encoding of the input. Undecodable bytes are replaced rather than raising.
+    use_mmap : bool
+        If true, read regular files through a read-only memory map instead of buffered reads.
+
+    """
+
+    def __init__(self, filename: str = None, stream: BinaryIO = None, chunk_size: int = DEFAULT_CHUNK_SIZE, encoding: str = DEFAULT_ENCODING, use_mmap: bool = True):
+        if stream is None and bad_string(filename):
+            alert = "CSVInput: please provide a filename or stream to read"
+            logerr(alert)
+            raise TypeError(alert)
+        if stream is None and not ntpath.exists(filename):
+            alert = f"CSVInput: could not find file '{filename}'"
+            logerr(alert)
+            raise TypeError(alert)
+        self.filename = filename
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        # A regular file, compressed or not
+        self.is_file = stream is None and stat.S_ISREG(os.stat(filename).st_mode)
+        self.compression: str = None
+        if self.is_file:
+            with open(filename, 'rb') as handle:
+                self.compression = detect_compression(handle.read(8))
+            if self.compression is not None:
+                logdbg("CSVInput: '%s' is %s compressed", filename, self.compression)
+        self.seekable = self.is_file and self.compression is None
+        # mmap can't map empty files
+        self.use_mmap = use_mmap and self.seekable and os.stat(filename).st_size > 0
+        self._source: BinaryIO = None
+        self._raw_source: BinaryIO = None
+        self._spool: BinaryIO = None
+        self._spooled = False
+
+    def _open_source(self) -> BinaryIO:
+        if self.stream is not None:
+            self._raw_source = self.stream
+        else:
+            self._raw_source = open(self.filename, 'rb', buffering=self.chunk_size)
+        if not self.is_file and hasattr(self._raw_source, "peek"):
+            # Streams can only be checked for compression once they're open, without consuming anything
+            self.compression = detect_compression(self._raw_source.peek(8)[:8])
+            if self.compression is not None:
+                logdbg("CSVInput: input is %s compressed", self.compression)
+        if self.compression is not None:
+            return open_decompressed(self._raw_source, self.compression)
+        return self._raw_source
+
+    def raw_lines(self, start: int = 0, follow: bool = False) -> Generator[bytes, None, None]:
+        """
+        Yield the raw (undecoded) lines of the input, including line endings.
+        Every call starts again from byte offset `start` (which should be the start of a line),
+        and is independent of any other pass that is still in progress.
+        If `follow` is true and the input is a regular file, keep waiting for lines to be appended
+        to the file after reaching its end, like `tail -f`.
+        """
+        if self.use_mmap:
+            # Each pass gets its own mapping so that they don't share a file position
+            with open(self.filename, 'rb') as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                mapping.seek(start)
+                yield from iter(mapping.readline, b"")
+                end = mapping.tell()
+            if follow:
+                yield from self._follow(end)
+            return
+
+        if self.seekable:
+            with open(self.filename, 'rb', buffering=self.chunk_size) as handle:
+                handle.seek(start)
+                yield from handle
+                end = handle.tell()
+            if follow:
+                yield from self._follow(end)
+            return
+
+        if self._spool is None:
+            self._source = self._open_source()
+            self._spool = tempfile.TemporaryFile(buffering=self.chunk_size)
+        elif start < self._spool.seek(0, os.SEEK_END):
+            # Replay what earlier passes have read so far (not with `yield from`, which
+            # would close the spool file if this pass is closed before the end)
+            self._spool.seek(start)
+            for raw_line in self._spool:
+                yield raw_line
+            self._spool.seek(0, os.SEEK_END)
+        if self._spooled:
+            return
+
+        # Continue reading from the source (if an earlier pass stopped early, from where it stopped),
+        # skipping any lines before `start` that haven't been read yet
+        position = self._spool.tell()
+        for raw_line in self._source:
+            self._spool.write(raw_line)
+            position += len(raw_line)
+            if position > start:
+                yield raw_line
+        self._spooled = True
+
+    def _follow(self, start: int, poll_interval: float = DEFAULT_FOLLOW_INTERVAL) -> Generator[bytes, None, None]:
+        # Only the bytes appended since the last poll are read, and only complete lines are passed on.
+        # If the file shrinks, it was truncated or replaced, so start over from its beginning.
+        partial = b""
+        with open(self.filename, 'rb') as handle:
+            handle.seek(start)
+            while True:
+                raw_line = handle.readline()
+                if raw_line.endswith(b"\n"):
+                    yield partial + raw_line
+                    partial = b""
+                    continue
+                partial += raw_line
+                time.sleep(poll_interval)
+                if os.stat(self.filename).st_size < handle.tell():
+                    logdbg("CSVInput: '%s' was truncated, following it from the start", self.filename)
+                    handle.seek(0)
+                    partial = b""
+
+    def tail_offset(self, num_lines: int) -> int:
+        """
+        Byte offset of the start of the last `num_lines` lines of a seekable input, found by reading it
+        backwards from its end. 0 if it doesn't have that many lines.
+        """
+        with open(self.filename, 'rb') as handle:
+            end = handle.seek(0, os.SEEK_END)
+            position = end
+            found = 0
+            while position > 0:
+                size = min(self.chunk_size, position)
+                position -= size
+                handle.seek(position)
+                chunk = handle.read(size)
+                index = len(chunk)
+                if position + size == end and chunk.endswith(b"\n"):
+                    # The last newline ends the last line, it doesn't start another one
+                    index -= 1
+                while True:
+                    index = chunk.rfind(b"\n", 0, index)
+                    if index < 0:
+                        break
+                    found += 1
+                    if found == num_lines:
+                        return position + index + 1
+        return 0
+
+    def lines(self, start: int = 0, follow: bool = False) -> Generator[str, None, None]:
+        """
+        Yield the decoded lines of the input without their line endings.
+        Every call starts again from byte offset `start`, see `raw_lines()`.
+        """
+        encoding = self.encoding
+        for raw_line in self.raw_lines(start, follow):
+            yield raw_line.decode(encoding, "replace").rstrip("\r\n")
+
+    def size(self) -> int:
+        """
+        Size of the input in bytes: of the file (compressed or not), or for other input, of what has been read so far.
+        """
+        if self.is_file:
+            return os.path.getsize(self.filename)
+        if self._spool is None:
+            return 0
+        return self._spool.seek(0, os.SEEK_END)
+
+    def content_hash(self) -> str:
+        """
+        Hash of the whole content of the input. Non-seekable input is read to its end (and spooled) to compute it.
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        for raw_line in self.raw_lines():
+            digest.update(raw_line)
+        return digest.hexdigest()
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        # Closing a decompressor doesn't close the stream it reads from
+        for source in (self._source, self._raw_source):
+            if source is not None and source is not self.stream:
+                source.close()
+        self._source = None
+        self._raw_source = None
+
+
 def get_comments(file_contents: str) -> str:
     comment_rows: list[str] = list()
     if bad_string(file_contents):
@@ -242,23 +615,140 @@ def get_max_column_widths(lines: list[str], column_delimiter: str) -> list[int]:
 
     """
     widths: list[int] = list()
-    rows: list[list[str]] = list(map(lambda line: line.strip().split(column_delimiter), lines))
-    logdbg(f"get_max_column_widths: rows:\n{rows}")
+    rows: list[list[str]] = list(RowTokenizer(lines, column_delimiter))
+    logdbg("get_max_column_widths: rows:\n%s", rows)
     # reader = csv.reader(data_lines, delimiter=column_delimiter)
     for rownum, row in enumerate(rows):
-        logdbg(f"ROW {rownum}: '{row}'")
-        for i, field in enumerate(row):
-            trimmed_field = field.strip()
-            if trimmed_field == "":
-                trimmed_field = '""';
-            chars = len(trimmed_field)
-            if chars == 0:
-                chars = 2
-            if len(widths) <= i:
-                widths.append(chars)
-            else:
-                widths[i] = max(widths[i], chars)
-    logdbg(f"MAX_WIDTHS: {widths}")
+        if debug:
+            logdbg("ROW %s: '%s'", rownum, row)
+        update_column_widths(widths, row)
+    logdbg("MAX_WIDTHS: %s", widths)
+    return widths
+
+
+def transpose_rows(rows: list[list[AnyStr]]) -> Generator[tuple[list[tuple[AnyStr, ...]], list[list[AnyStr]], AnyStr], None, None]:
+    """
+    Turn a batch of rows into columns, for the first pass to measure and classify them a column at a time
+    (see `update_batch_widths()` and `NumericColumns`). Raw rows (see `RowTokenizer`) and decoded rows are turned
+    separately, so that the cells of a column all have the same type. For each kind, yields the columns, the rows,
+    and the empty value of their type, which stands in for the cells missing from short rows.
+    """
+    raw_rows = [row for row in rows if len(row) > 0 and type(row[0]) == bytes]
+    if len(raw_rows) > 0:
+        yield list(itertools.zip_longest(*raw_rows, fillvalue=b"")), raw_rows, b""
+    if len(raw_rows) < len(rows):
+        str_rows = [row for row in rows if len(row) == 0 or type(row[0]) != bytes] if len(raw_rows) > 0 else rows
+        yield list(itertools.zip_longest(*str_rows, fillvalue="")), str_rows, ""
+
+
+def update_batch_widths(widths: list[int], columns: list[tuple[AnyStr, ...]], rows: list[list[AnyStr]]):
+    """
+    Same as `update_column_widths()` for each of `rows`, but a column at a time, from the `columns` of
+    the rows (see `transpose_rows()`), so the cells are measured by builtins instead of one by one.
+    """
+    num_widths = len(widths)
+    for i, values in enumerate(columns):
+        if type(values[0]) == bytes:
+            width = max(map(len, map(bytes.strip, values)))
+        else:
+            values = list(map(str.strip, values))
+            width = max(map(len, values)) if all(map(str.isascii, values)) else max(map(display_width, values))
+        if width < 2 and any(len(row) > i and not row[i].strip() for row in rows):
+            # Room to show empty fields as "" (cells missing from short rows don't count)
+            width = 2
+        if i >= num_widths:
+            widths.append(width)
+            num_widths += 1
+        elif width > widths[i]:
+            widths[i] = width
+
+
+# Display width (in terminal cells) of each character seen so far in non-ASCII text, see `display_width()`
+char_widths: dict[str, int] = {chr(code): 1 for code in range(128)}
+
+
+def char_width(char: str) -> int:
+    """
+    Number of terminal cells a character takes up: 2 for wide and fullwidth East Asian characters (including
+    most emoji), 0 for combining marks and other zero-width characters, and 1 for everything else.
+    """
+    if unicodedata.combining(char) or unicodedata.category(char) in ("Mn", "Me", "Cf"):
+        return 0
+    if unicodedata.east_asian_width(char) in ("W", "F"):
+        return 2
+    return 1
+
+
+def display_width(text: str) -> int:
+    """
+    Number of terminal cells a string takes up when printed, which is its length if it's pure ASCII.
+    Other strings are measured with the `char_widths` lookup table, which `char_width()` adds new characters to
+    the first time they are seen, so each distinct character is only looked up in the Unicode database once.
+    """
+    if text.isascii():
+        return len(text)
+    try:
+        return sum(map(char_widths.__getitem__, text))
+    except KeyError:
+        for char in text:
+            if char not in char_widths:
+                char_widths[char] = char_width(char)
+        return sum(map(char_widths.__getitem__, text))
+
+
+def pad_to_width(text: str, width: int, align_right: bool = False) -> str:
+    """
+    Left-justify (or right-justify) a string in a column `width` terminal cells wide, like `str.ljust()`
+    (or `str.rjust()`) but by display width.
+    """
+    if text.isascii():
+        return text.rjust(width) if align_right else text.ljust(width)
+    padding = " " * (width - display_width(text))
+    return padding + text if align_right else text + padding
+
+
+def truncate_to_width(text: str, width: int) -> str:
+    """
+    Return the longest start of a string that takes up at most `width` terminal cells.
+    """
+    if text.isascii():
+        return text[:width]
+    used = 0
+    for i, char in enumerate(text):
+        used += display_width(char)
+        if used > width:
+            return text[:i]
+    return text
+
+
+def update_column_widths(widths: list[int], fields: list[str]) -> list[int]:
+    """
+    Widen the running per-column maximum widths in `widths` (in place) so they fit the given row.
+    Widths are display widths (see `display_width()`), and empty fields count as 2 cells wide, so there is room
+    to show them as "". Fields may also be raw ASCII bytes (see `RowTokenizer`).
+
+    Parameters
+    ----------
+    widths : list[int]
+        Running maximum widths of each column, extended as needed for rows with more columns.
+    fields : list[str]
+        Values of the columns of a single row.
+
+    Returns
+    -------
+    list[int]
+        The updated `widths` list.
+
+    """
+    num_widths = len(widths)
+    for i, field in enumerate(fields):
+        field = field.strip()
+        chars = (len(field) if field.isascii() else display_width(field)) or 2
+        if i >= num_widths:
+            widths.append(chars)
+            num_widths += 1
+        elif chars > widths[i]:
+            widths[i] = chars
     return widths
 
 
@@ -292,15 +782,13 @@ def get_max_widths(file_contents: str, column_delimiter: str) -> list[int]:
     # Parse the non-comment lines and get the maximum number of columns
     num_data_cols = 0
     # reader = csv.reader(data_lines, delimiter=column_delimiter)
-    for i, dline in enumerate(data_lines):
-        row = dline.strip().split(column_delimiter)
+    for row in RowTokenizer(data_lines, column_delimiter):
         cols_in_row = len(row)
-        if cols_in_row > 0:
-            lines_to_consider.append(dline)
         if cols_in_row > num_data_cols:
             num_data_cols = cols_in_row
+    lines_to_consider.extend(data_lines)
 
-    logdbg(f"get_max_widths: {num_data_cols} columns in data")
+    logdbg("get_max_widths: %s columns in data", num_data_cols)
 
     # Parse the comment lines and see if any of them match the number of data columns.
     # If any of them do, add them to the list of lines to consider when calculating the
@@ -309,18 +797,18 @@ def get_max_widths(file_contents: str, column_delimiter: str) -> list[int]:
     # Strip away comment character and whitespace around it
     stripped_comment_lines = list(map(lambda x: x.strip().strip("#").strip(), comment_lines))
     for i, cline in enumerate(stripped_comment_lines):
-        split_comment = cline.strip().split(column_delimiter)
+        split_comment = next(RowTokenizer([cline], column_delimiter), [])
         comment_cols = len(split_comment)
-        # logdbg(f"get_max_widths: comment {i} appears to consist of {comment_cols} columns")
+        # logdbg("get_max_widths: comment %s appears to consist of %s columns", i, comment_cols)
         if comment_cols == num_data_cols:
             # This column is probably a header, add it to the rows used to calculate max column widths
-            logdbg(f"get_max_widths: COL COUNT MATCH for #{i}: {comment_cols} == {num_data_cols}:\n{cline}")
+            logdbg("get_max_widths: COL COUNT MATCH for #%s: %s == %s:\n%s", i, comment_cols, num_data_cols, cline)
             num_comment_cols = comment_cols
             lines_to_consider.insert(0, cline)
         else:
-            logdbg(f"get_max_widths: comment #{i} appears to consist of {comment_cols} columns")
+            logdbg("get_max_widths: comment #%s appears to consist of %s columns", i, comment_cols)
 
-    logdbg(f"get_max_widths: considering lines:\n{lines_to_consider}")
+    logdbg("get_max_widths: considering lines:\n%s", lines_to_consider)
     max_widths = get_max_column_widths(lines_to_consider, column_delimiter)
     return max_widths
 
@@ -358,12 +846,7 @@ def guess_delimiter(file_contents: str) -> str:
     #     file_lines = list(csvfile.readlines())
     good_lines = filter(lambda line: line != '' and line[0] != '#', file_lines)
     input_contents = "\n".join(good_lines)
-    dialect = csv.Sniffer().sniff(input_contents)
-    if dialect is None:
-        alert = "guess_delimiter: could not determine file delimiter character"
-        logerr(alert)
-        raise TypeError(alert)
-    output_delimiter = dialect.delimiter
+    output_delimiter = sniff_sample(input_contents)
     if output_delimiter is not None:
         return output_delimiter
     else:
@@ -372,6 +855,97 @@ def guess_delimiter(file_contents: str) -> str:
         raise TypeError(alert)
 
 
+def sniff_sample(sample: str) -> Union[str, None]:
+    """
+    Run the csv module's Sniffer over a sample of data lines and return the delimiter it finds,
+    or None if it can't tell.
+    """
+    try:
+        return csv.Sniffer().sniff(sample).delimiter
+    except csv.Error:
+        return None
+
+
+def read_sample(lines: Iterable[AnyStr], sniff_bytes: int = DEFAULT_SNIFF_BYTES, encoding: str = DEFAULT_ENCODING, max_lines: int = None) -> str:
+    """
+    Collect data lines (skipping comments and blank lines) from `lines` until about `sniff_bytes`
+    bytes (or `max_lines` lines) have been gathered, and return them decoded and joined as a single string.
+    """
+    sample: list[str] = list()
+    sample_bytes = 0
+    for line in lines:
+        if type(line) == bytes:
+            line = line.decode(encoding, "replace")
+        line = line.rstrip("\r\n")
+        if line.startswith(COMMENT_CHAR) or line.strip() == "":
+            continue
+        sample.append(line)
+        sample_bytes += len(line) + 1
+        if sample_bytes >= sniff_bytes or len(sample) == max_lines:
+            break
+    return "\n".join(sample)
+
+
+def sniff_delimiter(csv_input: CSVInput, sniff_bytes: int = DEFAULT_SNIFF_BYTES, random_samples: int = DEFAULT_SNIFF_SAMPLES, max_lines: int = None) -> tuple[str, float]:
+    """
+    Guess the column delimiter of an input from a bounded amount of data: the first `sniff_bytes`
+    bytes of data lines, plus (for regular files) `random_samples` more samples of the same size
+    taken from random offsets in the file. Each sample is sniffed separately and the delimiter
+    found most often wins.
+
+    The result is cached with the rest of the layout: a layout from `LayoutCache` or the index file
+    (see `write_layout_file()`) already has its delimiter, so the input isn't sniffed again.
+
+    Parameters
+    ----------
+    csv_input : CSVInput
+        The input to analyze.
+    sniff_bytes : int
+        Approximate number of bytes in each sample.
+    random_samples : int
+        Number of samples to take from random offsets, in addition to the start of the input.
+        Ignored for input that can't be seeked, like stdin.
+    max_lines : int
+        If given, also limit each sample to this many lines, so sniffing a slowly growing stream doesn't
+        have to wait for `sniff_bytes` bytes to arrive.
+
+    Returns
+    -------
+    tuple[str, float]
+        The delimiter, and the confidence in it between 0 and 1: the fraction of samples that agree
+        on it, times the fraction of lines in the first sample with the most common number of columns.
+
+    """
+    lines = csv_input.raw_lines()
+    samples = [read_sample(lines, sniff_bytes, csv_input.encoding, max_lines)]
+    lines.close()
+    if random_samples > 0 and csv_input.seekable:
+        file_size = os.path.getsize(csv_input.filename)
+        if file_size > sniff_bytes:
+            # Seed with the file size, so the same file is always sampled the same way
+            rng = random.Random(file_size)
+            for offset in sorted(rng.randrange(sniff_bytes, file_size) for _ in range(random_samples)):
+                lines = csv_input.raw_lines(offset)
+                # The offset is most likely in the middle of a line, skip the partial line
+                next(lines, None)
+                samples.append(read_sample(lines, sniff_bytes, csv_input.encoding, max_lines))
+                lines.close()
+
+    guesses = Counter(sniff_sample(sample) for sample in samples if sample != "")
+    guesses.pop(None, None)
+    if len(guesses) == 0:
+        alert = "sniff_delimiter: could not determine file delimiter character"
+        logerr(alert)
+        raise TypeError(alert)
+    delimiter, votes = guesses.most_common(1)[0]
+
+    column_counts = Counter(len(row) for row in csv.reader(samples[0].split("\n"), delimiter=delimiter))
+    consistency = column_counts.most_common(1)[0][1] / sum(column_counts.values()) if len(column_counts) > 0 else 0.0
+    confidence = (votes / len(samples)) * consistency
+    logdbg("sniff_delimiter: guesses from %s sample(s): %s, confidence %.2f", len(samples), dict(guesses), confidence)
+    return delimiter, confidence
+
+
 # Colorize the columns of a row and return a new list of the colorized strings
 def colorize_row(row: list[str], max_widths: list[int], quote_empty: bool = False, left_padding: int = PADDING_LEFT, right_padding: int = PADDING_RIGHT, colors_bold: bool = DEFAULT_BOLD, plain_text: bool = DEFAULT_PLAIN_TEXT, dim_color: bool = False, underline_color: bool = False) -> list[str]:
     """
@@ -417,11 +991,2019 @@ def colorize_row(row: list[str], max_widths: list[int], quote_empty: bool = Fals
             color = colors[i % len(colors)]
             # Print the field colorized and padded to the column width
             # print(colorize(trimmed_field.ljust(max_widths[i]), color), end=output_separator)
-            color_row.append(colorize(padding_left_str + trimmed_field.ljust(max_widths[i]) + padding_right_str, color, colors_bold, plain_text, dim_color, underline_color))
+            color_row.append(colorize(padding_left_str + pad_to_width(trimmed_field, max_widths[i]) + padding_right_str, color, colors_bold, plain_text, dim_color, underline_color))
 
     return color_row
 
 
+class RowRenderer:
+    """
+    Fast equivalent of `colorize_row()` for formatting many rows with the same settings.
+
+    The escape sequences for each column's color, the padding and the column widths are worked out once
+    (termcolor is only called once per color, when the renderer is created), and compiled into a single
+    format string for a whole row. Formatting a row is then one `str.format()` call, with no per-cell
+    library calls. If `max_widths` changes, call `refresh()` before rendering more rows.
+
+    Parameters
+    ----------
+    max_widths: list[int]
+        A list of integers where each element is the maximum width of the corresponding CSV/TSV column.
+    output_separator : str
+        String to use to separate columns in the output.
+    quote_empty: bool
+        If false, empty columns will be represented as empty strings. If true, represent them with a pair of double quotes.
+    left_padding: int
+        The number of spaces to prepend to each column, for spacing the output.
+    right_padding: int
+        The number of spaces to append to each column, for spacing the output.
+    colors_bold: bool
+        If true, use bold colors. If false, use regular colors.
+    plain_text: bool
+        If true, don't colorize the output. If false, use the standard colors.
+    dim_color: bool
+        If true, try to use darker/dimmer colors. If false, use the standard colors.
+    underline_color: bool
+        If true, underline the column values. If false, do not underline column values.
+    columns: list[int]
+        If given, only render these columns of each row (by index, see `visible_columns()`), in the colors
+        they have in the full row. Missing cells are rendered as empty.
+    numeric_columns: NumericColumns
+        If given, right-align the columns it found to be numeric. All columns are left-aligned otherwise.
+    align_decimals: bool
+        If true, also line up the decimal points of the numbers in the numeric columns (see `align_decimal()`).
+        The columns must be wide enough for that, see `FileLayout.align_decimals()`.
+
+    """
+
+    def __init__(self, max_widths: list[int], output_separator: str = "\t", quote_empty: bool = False, left_padding: int = PADDING_LEFT, right_padding: int = PADDING_RIGHT, colors_bold: bool = DEFAULT_BOLD, plain_text: bool = DEFAULT_PLAIN_TEXT, dim_color: bool = False, underline_color: bool = False, columns: list[int] = None, numeric_columns: "NumericColumns" = None, align_decimals: bool = False):
+        self.max_widths = max_widths
+        self.columns = columns
+        self.numeric_columns = numeric_columns
+        self.align_decimals = align_decimals
+        self.output_separator = output_separator
+        self.quote_empty = quote_empty
+        padding_left_str = " " * left_padding
+        padding_right_str = " " * right_padding
+        # Text before and after the value of a cell, for each color: the color's escape sequence and the padding
+        self._color_codes: list[tuple[str, str]] = list()
+        for color in colors:
+            prefix, suffix = colorize("\0", color, colors_bold, plain_text, dim_color, underline_color).split("\0")
+            self._color_codes.append((prefix + padding_left_str, padding_right_str + suffix))
+        self._widths: list[int] = list()
+        self._align_right: list[bool] = list()
+        # (position in the rendered row, integer width, fraction width) of the columns to align on the decimal point
+        self._decimal_columns: list[tuple[int, int, int]] = list()
+        self._template = ""
+        self._ascii_template = True
+        self.refresh()
+
+    def refresh(self):
+        """
+        Rebuild the row template if `max_widths` has changed.
+        """
+        def escape(text: str) -> str:
+            return text.replace("{", "{{").replace("}", "}}")
+
+        max_widths = self.max_widths
+        if self.columns is not None:
+            max_widths = [max_widths[i] if i < len(max_widths) else 0 for i in self.columns]
+        if self._widths == max_widths and self._template != "":
+            return
+        self._widths = list(max_widths)
+        numeric = self.numeric_columns.numeric() if self.numeric_columns is not None else []
+        num_numeric = len(numeric)
+        num_colors = len(self._color_codes)
+        cells: list[str] = list()
+        self._align_right = list()
+        self._decimal_columns = list()
+        for position, (i, width) in enumerate(zip(self.columns if self.columns is not None else itertools.count(), self._widths)):
+            prefix, suffix = self._color_codes[i % num_colors]
+            align_right = i < num_numeric and numeric[i]
+            cells.append(escape(prefix) + "{:" + (">" if align_right else "<") + str(width) + "}" + escape(suffix))
+            self._align_right.append(align_right)
+            if align_right and self.align_decimals:
+                self._decimal_columns.append((position, self.numeric_columns.integer_widths[i], self.numeric_columns.fraction_widths[i]))
+        self._template = escape(self.output_separator).join(cells)
+        self._ascii_template = self._template.isascii()
+
+    def render(self, row: list[str]) -> str:
+        """
+        Format a row, with its cells separated by the output separator.
+        """
+        if self.columns is not None:
+            num_fields = len(row)
+            row = [row[i] if i < num_fields else "" for i in self.columns]
+        if self.quote_empty:
+            fields = [field.strip() or '""' for field in row]
+        else:
+            fields = [field.strip() for field in row]
+        if self._decimal_columns:
+            num_fields = len(fields)
+            for position, integer_width, fraction_width in self._decimal_columns:
+                if position < num_fields:
+                    fields[position] = align_decimal(fields[position], integer_width, fraction_width)
+        if len(fields) == len(self._widths):
+            line = self._template.format(*fields)
+            # The template pads by length, which is only the display width for ASCII text
+            if line.isascii() or (not self._ascii_template and all(map(str.isascii, fields))):
+                return line.replace("\n", NEWLINE_MARKER) if "\n" in line else line
+
+        # Row doesn't have the usual number of columns, or has wide or zero-width characters: format it cell by cell
+        widths = self._widths
+        num_widths = len(widths)
+        align_right = self._align_right
+        color_codes = self._color_codes
+        num_colors = len(color_codes)
+        cells: list[str] = list()
+        # Colors go by the column in the input, like in the template (see `refresh()`)
+        for i, (column, field) in enumerate(zip(self.columns if self.columns is not None else itertools.count(), fields)):
+            prefix, suffix = color_codes[column % num_colors]
+            field = field.replace("\n", NEWLINE_MARKER)
+            cells.append(prefix + (pad_to_width(field, widths[i], align_right[i]) if i < num_widths else field) + suffix)
+        return self.output_separator.join(cells)
+
+
+def visible_columns(max_widths: list[int], first_column: int, screen_width: int, frozen_columns: int = 0, cell_padding: int = PADDING_LEFT + PADDING_RIGHT, separator_width: int = 1, line_prefix_width: int = 0) -> list[int]:
+    """
+    Return the indexes of the columns that fit on a screen `screen_width` characters wide when the output is scrolled
+    sideways to `first_column`: the first `frozen_columns` columns, which are always shown, then the columns from
+    `first_column` on, as many as fit (and always at least one), using `max_widths` for the width of each column.
+    """
+    num_columns = len(max_widths)
+    frozen_columns = min(max(0, frozen_columns), num_columns)
+    columns: list[int] = list()
+    used = line_prefix_width - separator_width
+    for i in itertools.chain(range(frozen_columns), range(max(first_column, frozen_columns), num_columns)):
+        width = separator_width + cell_padding + max_widths[i]
+        if used + width > screen_width and len(columns) > frozen_columns:
+            break
+        columns.append(i)
+        used += width
+    return columns
+
+
+class RowIndex:
+    """
+    Sparse index of where data rows start in an input: the byte offset of every `DEFAULT_INDEX_ROWS`th row or so,
+    built by the first pass. To get to any row, start reading at the nearest indexed row before it (see `lookup()`)
+    and skip the few rows in between.
+
+    Attributes
+    ----------
+    rows : list[int]
+        Indexed row numbers (0 is the first data row), in increasing order.
+    offsets : list[int]
+        Byte offset in the input of the start of each indexed row.
+
+    """
+
+    def __init__(self):
+        self.rows: list[int] = list()
+        self.offsets: list[int] = list()
+
+    def add(self, row: int, offset: int):
+        self.rows.append(row)
+        self.offsets.append(offset)
+
+    def extend(self, other: "RowIndex", row_shift: int = 0, offset_shift: int = 0):
+        """
+        Append the entries of another index, with `row_shift` and `offset_shift` added to them.
+        """
+        self.rows.extend(row + row_shift for row in other.rows)
+        self.offsets.extend(offset + offset_shift for offset in other.offsets)
+
+    def lookup(self, row: int) -> tuple[int, int]:
+        """
+        Return the row number and byte offset of the last indexed row at or before `row`.
+        """
+        i = bisect.bisect_right(self.rows, row) - 1
+        if i < 0:
+            return 0, 0
+        return self.rows[i], self.offsets[i]
+
+    def to_dict(self) -> dict:
+        return {"rows": self.rows, "offsets": self.offsets}
+
+    @staticmethod
+    def from_dict(values: dict) -> "RowIndex":
+        index = RowIndex()
+        index.rows = list(values["rows"])
+        index.offsets = list(values["offsets"])
+        return index
+
+
+class FileLayout:
+    """
+    Everything the first pass learns about a CSV/TSV file that the second (rendering) pass needs.
+    Its size depends on the number of columns and comment lines, never on the number of data rows
+    (unless the tokenized rows were kept, see `rows`).
+
+    Attributes
+    ----------
+    delimiter : str
+        Column delimiter used by the input.
+    max_widths : list[int]
+        Maximum width of each column, including any comment row that looks like a header.
+    num_columns : int
+        Number of columns in the first data row, used to recognize header rows among the comments.
+    comment_rows : list[str]
+        Comment lines of the input (with surrounding whitespace removed), in file order.
+    num_rows : int
+        Number of data rows in the input (or in the sample, if the layout is not complete).
+    complete : bool
+        False if the layout was estimated from a sample of the input rows, in which case
+        wider cells and more comments may appear later in the input.
+    rows : Iterable[list[str]]
+        The data rows as tokenized by the first pass, if `scan_layout()` was asked to keep them,
+        so the second pass can render them without reading and tokenizing the input again
+        (or a `SortedRows`, from `scan_sorted()`). Otherwise None.
+    row_index : RowIndex
+        Where the data rows start in the input, if `scan_layout()` was asked to index them. Otherwise None.
+    row_filter : RowFilter
+        The columns and rows the layout was measured with, if not all of them. The rendering pass applies it as well.
+    numeric_columns : NumericColumns
+        Which columns hold numbers, for right-aligning them.
+    column_stats : list[ColumnStats]
+        Summary of the values of each (selected) column, if `scan_layout()` was asked to collect it. Otherwise None.
+
+    """
+
+    def __init__(self, delimiter: str):
+        self.delimiter = delimiter
+        self.max_widths: list[int] = list()
+        self.num_columns = 0
+        self.comment_rows: list[str] = list()
+        self.num_rows = 0
+        self.complete = True
+        self.rows: list[list[str]] = None
+        self.row_index: RowIndex = None
+        self.row_filter: RowFilter = None
+        self.numeric_columns = NumericColumns()
+        self.column_stats: list[ColumnStats] = None
+
+    def split_comment(self, comment_row: str) -> list[str]:
+        """
+        Split a comment row into columns, keeping only the selected columns if it's a header.
+        """
+        fields = next(RowTokenizer([comment_row.strip(COMMENT_CHAR)], self.delimiter), [])
+        if self.row_filter is not None and self.num_columns > 0 and len(fields) == self.num_columns:
+            return self.row_filter.project(fields)
+        return fields
+
+    def is_header(self, comment_row: str) -> bool:
+        """
+        A comment row with exactly as many columns as the data is probably a header.
+        """
+        return self.num_columns > 0 and len(next(RowTokenizer([comment_row.strip(COMMENT_CHAR)], self.delimiter), [])) == self.num_columns
+
+    def header_names(self) -> Union[list[str], None]:
+        """
+        The column names from the last comment row that looks like a header (see `is_header()`), or None if there is none.
+        """
+        for comment_row in reversed(self.comment_rows):
+            if self.is_header(comment_row):
+                return [field.strip() for field in self.split_comment(comment_row)]
+        return None
+
+    def align_decimals(self, rows: Iterable[list[str]] = None):
+        """
+        Widen the numeric columns (in place) so their numbers fit when aligned on the decimal point (see `align_decimal()`).
+        Their numbers are measured the first time, from `rows` or else the kept rows (see `NumericColumns.measure_decimals()`).
+        """
+        numeric_columns = self.numeric_columns
+        numeric_columns.measure_decimals(rows if rows is not None else self.rows or [])
+        for i, numeric in enumerate(numeric_columns.numeric()):
+            if numeric and i < len(self.max_widths):
+                self.max_widths[i] = max(self.max_widths[i], numeric_columns.integer_widths[i] + numeric_columns.fraction_widths[i])
+
+    def to_dict(self) -> dict:
+        """
+        Everything about a complete layout that `from_dict()` needs to restore it (the kept rows, if any, are left out).
+        """
+        return {
+            "delimiter": self.delimiter,
+            "max_widths": self.max_widths,
+            "num_columns": self.num_columns,
+            "comment_rows": self.comment_rows,
+            "num_rows": self.num_rows,
+            "numeric_columns": self.numeric_columns.to_dict(),
+            "row_index": self.row_index.to_dict() if self.row_index is not None else None,
+        }
+
+    @staticmethod
+    def from_dict(values: dict) -> "FileLayout":
+        layout = FileLayout(values["delimiter"])
+        layout.max_widths = list(values["max_widths"])
+        layout.num_columns = values["num_columns"]
+        layout.comment_rows = list(values["comment_rows"])
+        layout.num_rows = values["num_rows"]
+        layout.numeric_columns = NumericColumns.from_dict(values["numeric_columns"])
+        if values.get("row_index") is not None:
+            layout.row_index = RowIndex.from_dict(values["row_index"])
+        return layout
+
+
+class RowFilter:
+    """
+    Selection of the columns and rows of an input to show. It's applied by `RowTokenizer` as rows are tokenized,
+    so columns and rows that aren't shown are never measured or rendered, and don't count towards the column widths.
+
+    Parameters
+    ----------
+    columns : list[str]
+        Columns to show, in this order, by name (as in the header) or by number (counted from 1).
+        All columns are shown if this is empty.
+    conditions : list[str]
+        Conditions that a row must meet (all of them) to be shown, each one of: `COLUMN=VALUE`, `COLUMN!=VALUE`,
+        `COLUMN~REGEX` (the regular expression matches part of the value) or `COLUMN!~REGEX`. Values are compared
+        without their surrounding whitespace. Columns are given the same way as in `columns`.
+    header : list[str]
+        Column names, for looking up columns given by name (see `read_header()`).
+
+    """
+
+    CONDITION_PATTERN = re.compile(r"^(.+?)(!=|!~|=|~)(.*)$")
+
+    def __init__(self, columns: list[str] = None, conditions: list[str] = None, header: list[str] = None):
+        self.header = header
+        self.columns: list[int] = [self.column_index(column) for column in columns or []]
+        # (column index, negate, compiled regex or value to compare with)
+        self.conditions: list[tuple[int, bool, Union[re.Pattern, str]]] = list()
+        for condition in conditions or []:
+            match = RowFilter.CONDITION_PATTERN.match(condition)
+            if match is None:
+                alert = f"RowFilter: invalid condition '{condition}', expected COLUMN=VALUE, COLUMN!=VALUE, COLUMN~REGEX or COLUMN!~REGEX"
+                logerr(alert)
+                raise TypeError(alert)
+            column, operator, value = match.groups()
+            try:
+                pattern = re.compile(value) if operator.endswith("~") else value.strip()
+            except re.error as e:
+                alert = f"RowFilter: invalid regular expression in condition '{condition}': {e}"
+                logerr(alert)
+                raise TypeError(alert)
+            self.conditions.append((self.column_index(column), operator.startswith("!"), pattern))
+
+    def column_index(self, column: str) -> int:
+        column = column.strip()
+        if column.isdigit() and int(column) > 0:
+            return int(column) - 1
+        if self.header is not None and column in self.header:
+            return self.header.index(column)
+        alert = f"RowFilter: unknown column '{column}', expected a column number or one of the names in the header: {self.header or []}"
+        logerr(alert)
+        raise TypeError(alert)
+
+    def project(self, row: list[AnyStr]) -> list[AnyStr]:
+        """
+        Return the selected columns of a row. Columns the row doesn't have are empty.
+        """
+        if len(self.columns) == 0:
+            return row
+        num_fields = len(row)
+        empty = row[0][:0] if num_fields > 0 else ""
+        return [row[i] if i < num_fields else empty for i in self.columns]
+
+    def matches(self, row: list[str]) -> bool:
+        num_fields = len(row)
+        for i, negate, pattern in self.conditions:
+            value = row[i].strip() if i < num_fields else ""
+            if type(pattern) == str:
+                matched = value == pattern
+            else:
+                matched = pattern.search(value) is not None
+            if matched == negate:
+                return False
+        return True
+
+
+class HyperLogLog:
+    """
+    Approximate count of distinct values in a fixed amount of memory: one byte for each of the 2 ** `precision`
+    registers, however many values there are. The standard error of the count is about 1.04 / sqrt(2 ** precision).
+    Counts of consecutive parts of an input are combined with `merge()`, e.g. from the worker processes of a scan.
+
+    Values are hashed with CRC-32, which is much faster than the hashes of hashlib and the same in every process
+    (unlike `hash()`), with its bits spread over 64 bits by a multiplication. Having only 2 ** 32 hashes, counts
+    of more than about 100 million values come out slightly low.
+    """
+
+    MIX_MULTIPLIER = 0x9E3779B97F4A7C15
+
+    def __init__(self, precision: int = DEFAULT_DISTINCT_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, values: Iterable[bytes]):
+        registers = self.registers
+        other_bits = 64 - self.precision
+        other_mask = (1 << other_bits) - 1
+        multiplier = HyperLogLog.MIX_MULTIPLIER
+        crc32 = zlib.crc32
+        for value in values:
+            hashed = (crc32(value) * multiplier) & 0xFFFFFFFFFFFFFFFF
+            hashed ^= hashed >> 29
+            # The first bits of the hash pick a register, which keeps the longest run of leading zeros seen in the other bits
+            register = hashed >> other_bits
+            rank = other_bits - (hashed & other_mask).bit_length() + 1
+            if rank > registers[register]:
+                registers[register] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        num_registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / num_registers)
+        estimate = alpha * num_registers * num_registers / sum(2.0 ** -rank for rank in self.registers)
+        empty_registers = self.registers.count(0)
+        if estimate <= 2.5 * num_registers and empty_registers > 0:
+            # For small counts, the number of registers still empty is the better estimate
+            estimate = num_registers * math.log(num_registers / empty_registers)
+        return round(estimate)
+
+
+class ColumnStats:
+    """
+    Summary of the values of one column, collected by the first pass (see `scan_layout()`) in a fixed amount of
+    memory: the type of the values, how many there are, how many are missing (see `NULL_VALUES`), roughly how many
+    are distinct (see `HyperLogLog`), and the smallest and largest of them.
+
+    The type is the first of `int`, `float`, `date` (ISO 8601, optionally with a time) and `string` that fits all the
+    values that aren't missing. Numbers are compared as numbers, other values as text, which puts ISO dates in order.
+    Values are added a batch at a time, so that most of the work is done by builtins over the whole batch.
+    """
+
+    TYPE_INT = "int"
+    TYPE_FLOAT = "float"
+    TYPE_DATE = "date"
+    TYPE_STRING = "string"
+    INT_PATTERN = re.compile(r"^[+-]?\d+$")
+    FLOAT_PATTERN = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$")
+    DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?)?$")
+
+    def __init__(self, precision: int = DEFAULT_DISTINCT_PRECISION):
+        self.type: str = None
+        self.count = 0
+        self.nulls = 0
+        self.distinct = HyperLogLog(precision)
+        self.min_text: str = None
+        self.max_text: str = None
+        # Smallest and largest numbers, along with their text in the input
+        self.min_number: tuple[Union[int, float], str] = None
+        self.max_number: tuple[Union[int, float], str] = None
+
+    def add(self, values: Iterable[Union[str, None]]):
+        """
+        Add a batch of values of the column. None stands for a cell that a row doesn't have, and is left out.
+        """
+        values = [value.strip() for value in values if value is not None]
+        present = [value for value in values if value.lower() not in NULL_VALUES]
+        self.nulls += len(values) - len(present)
+        if len(present) == 0:
+            return
+        self.count += len(present)
+        # Repeated values only need to be hashed once
+        self.distinct.add(value.encode(DEFAULT_ENCODING, "replace") for value in set(present))
+        self.min_text = min(present) if self.min_text is None else min(self.min_text, min(present))
+        self.max_text = max(present) if self.max_text is None else max(self.max_text, max(present))
+        # Once a column holds text, its type can't change anymore
+        if self.type == ColumnStats.TYPE_STRING:
+            return
+        numbers: list[Union[int, float]] = None
+        if all(map(ColumnStats.INT_PATTERN.match, present)):
+            try:
+                values_type, numbers = ColumnStats.TYPE_INT, list(map(int, present))
+            except ValueError:
+                # Too many digits for int() (see sys.get_int_max_str_digits()), they are compared as floats instead
+                values_type, numbers = ColumnStats.TYPE_FLOAT, list(map(float, present))
+        elif all(map(ColumnStats.FLOAT_PATTERN.match, present)):
+            values_type, numbers = ColumnStats.TYPE_FLOAT, list(map(float, present))
+        elif all(map(ColumnStats.DATE_PATTERN.match, present)):
+            values_type = ColumnStats.TYPE_DATE
+        else:
+            values_type = ColumnStats.TYPE_STRING
+        self.type = ColumnStats.combine_types(self.type, values_type)
+        if numbers is not None:
+            smallest = min(zip(numbers, present))
+            largest = max(zip(numbers, present))
+            self.min_number = smallest if self.min_number is None else min(self.min_number, smallest)
+            self.max_number = largest if self.max_number is None else max(self.max_number, largest)
+
+    @staticmethod
+    def combine_types(first: Union[str, None], second: Union[str, None]) -> Union[str, None]:
+        """
+        The type of a column that has values of both types (None being the type of a column without values).
+        """
+        if first is None or first == second:
+            return second
+        if second is None:
+            return first
+        if {first, second} == {ColumnStats.TYPE_INT, ColumnStats.TYPE_FLOAT}:
+            return ColumnStats.TYPE_FLOAT
+        return ColumnStats.TYPE_STRING
+
+    def merge(self, other: "ColumnStats"):
+        """
+        Add the values summarized by `other` (e.g. from another part of the input).
+        """
+        self.type = ColumnStats.combine_types(self.type, other.type)
+        self.count += other.count
+        self.nulls += other.nulls
+        self.distinct.merge(other.distinct)
+        for name, pick in (("min_text", min), ("max_text", max), ("min_number", min), ("max_number", max)):
+            values = [value for value in (getattr(self, name), getattr(other, name)) if value is not None]
+            setattr(self, name, pick(values) if len(values) > 0 else None)
+
+    def summary(self) -> list[str]:
+        """
+        The type, number of values, number of missing values, approximate number of distinct values, smallest
+        value and largest value, as text (see `STATS_COLUMNS`).
+        """
+        if self.type in (ColumnStats.TYPE_INT, ColumnStats.TYPE_FLOAT):
+            smallest, largest = self.min_number[1], self.max_number[1]
+        else:
+            smallest, largest = self.min_text or "", self.max_text or ""
+        return [self.type or "", str(self.count), str(self.nulls), str(self.distinct.count()), smallest, largest]
+
+
+def update_column_stats(stats: list[ColumnStats], rows: list[list[str]]) -> list[ColumnStats]:
+    """
+    Add the values of a batch of rows to the running per-column statistics in `stats` (in place),
+    which is extended as needed for rows with more columns.
+    """
+    for i, values in enumerate(itertools.zip_longest(*rows)):
+        if i >= len(stats):
+            stats.append(ColumnStats())
+        stats[i].add(values)
+    return stats
+
+
+class NumericColumns:
+    """
+    Which columns of an input hold numbers, so they can be right-aligned. A column is numeric if each of its cells
+    is a number, empty, or a missing value (see `NULL_VALUES`), and at least one of them is a number.
+
+    The first pass classifies the cells a batch of rows at a time with `update()`, and only in the columns that
+    are still numeric: once a column has held text, its cells aren't looked at anymore. The cells of a column are
+    joined and checked together by builtins (see `classify()`), so the cost per cell is small and constant.
+
+    For aligning numbers on their decimal point, `measure_decimals()` finds the width of the widest integer part
+    (before the ".") and of the widest fractional part (from the "." on) of each numeric column. That takes another
+    look at the rows, so it's only done when needed (see `FileLayout.align_decimals()`).
+
+    Attributes
+    ----------
+    candidates : list[bool]
+        For each column, false once a cell that isn't a number or missing has been seen in it.
+    has_numbers : list[bool]
+        For each column, true once a cell that is a number (rather than empty or missing) has been seen in it.
+    integer_widths : list[int]
+        Width of the widest integer part of the numbers in each column, once measured.
+    fraction_widths : list[int]
+        Width of the widest fractional part of the numbers in each column, including the decimal point, once measured.
+    decimals_measured : bool
+        Whether `integer_widths` and `fraction_widths` have been measured.
+
+    """
+
+    # A cell, and the cells of a column joined by newlines. Each string can only match one way, so a match
+    # that fails doesn't backtrack through the earlier cells.
+    CELL_PATTERN = rb"[ \t]*(?:(?:[+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?|(?i:" + b"|".join(re.escape(value.encode("ascii")) for value in sorted(NULL_VALUES, reverse=True) if value != "") + rb"))[ \t]*)?"
+    COLUMN_PATTERN = re.compile(b"(?:" + CELL_PATTERN + b"\n)*" + CELL_PATTERN)
+    INTEGER_PART_PATTERN = re.compile(rb"^[ \t]*([+-]?(?:[0-9][^. \t\n]*)?)", re.MULTILINE)
+    FRACTION_PATTERN = re.compile(rb"\.[^ \t\n]*")
+    NUMBER_CHARS_TO_ZEROS = bytes.maketrans(b"0123456789-", b"00000000000")
+    SIGNS_TO_POINTS = bytes.maketrans(b"-", b".")
+
+    def __init__(self):
+        self.candidates: list[bool] = list()
+        self.has_numbers: list[bool] = list()
+        self.integer_widths: list[int] = list()
+        self.fraction_widths: list[int] = list()
+        self.decimals_measured = False
+
+    def update(self, rows: list[list[AnyStr]]):
+        """
+        Classify the cells of a batch of rows. Fields may be raw ASCII bytes, like in `update_column_widths()`.
+        """
+        if len(rows) == 0 or (not any(self.candidates) and max(map(len, rows)) <= len(self.candidates)):
+            # Only columns already known to hold text
+            return
+        for columns, _, empty in transpose_rows(rows):
+            self.update_columns(columns, empty)
+
+    def update_columns(self, columns: list[tuple[AnyStr, ...]], empty: AnyStr):
+        """
+        Classify the cells of a batch of rows given as columns, of raw bytes or strings (see `transpose_rows()`).
+        """
+        candidates = self.candidates
+        has_numbers = self.has_numbers
+        for i, values in enumerate(columns):
+            if i >= len(candidates):
+                candidates.append(True)
+                has_numbers.append(False)
+            elif not candidates[i]:
+                continue
+            if empty == b"" and values[0].isdigit() and b"".join(values).isdigit():
+                # Only digits and empty cells (which the join leaves out), the most common column of numbers
+                has_numbers[i] = True
+                continue
+            cells = NumericColumns.join_column(values, empty)
+            numbers = NumericColumns.classify(cells) if cells is not None else None
+            if numbers is None:
+                candidates[i] = False
+            elif numbers:
+                has_numbers[i] = True
+
+    @staticmethod
+    def join_column(values: tuple[AnyStr, ...], empty: AnyStr) -> Union[bytes, None]:
+        """
+        The cells of a column as ASCII bytes joined by newlines, or None if they can't all be numbers.
+        """
+        if empty == b"":
+            return b"\n".join(values)
+        # Numbers are ASCII, and on one line (unlike quoted fields that span several)
+        cells = "\n".join(values)
+        return cells.encode("ascii") if cells.isascii() and cells.count("\n") == len(values) - 1 else None
+
+    @staticmethod
+    def classify(cells: bytes) -> Union[bool, None]:
+        """
+        Check some cells of a column, joined by newlines. Returns None if any of them isn't a number, empty or missing,
+        and otherwise whether any of them is a number.
+        """
+        # Plain integers and decimals are checked without looking at each cell: without their digits, the cells
+        # must only have decimal points (at most one each) and minus signs, each sign must start a cell, and
+        # no cell may end with a sign or point (so each has a digit). Cells such as "1-2", "-" and "5." are left
+        # for the check cell by cell.
+        skeleton = cells.translate(None, b"0123456789")
+        if skeleton.translate(None, b"\n.-") == b"" and b".." not in skeleton:
+            if b"-" not in skeleton and b"." not in skeleton:
+                # Only digits
+                return len(skeleton) < len(cells)
+            ends = cells.translate(NumericColumns.SIGNS_TO_POINTS) if b"-" in skeleton else cells
+            if b".\n" not in ends and not ends.endswith(b".") and (b"-" not in skeleton or skeleton.count(b"-") == cells.count(b"\n-") + cells.startswith(b"-")):
+                return True
+        # Anything else (signs, exponents, whitespace, missing values) is checked cell by cell
+        if NumericColumns.COLUMN_PATTERN.fullmatch(cells) is None:
+            return None
+        return len(skeleton) < len(cells)
+
+    def measure_decimals(self, rows: Iterable[list[AnyStr]]):
+        """
+        Measure the integer and fractional parts of the numbers in the numeric columns of `rows` (which must be
+        the rows that were classified), a batch of rows at a time, unless that has already been done.
+        """
+        if self.decimals_measured:
+            return
+        numeric = self.numeric()
+        self.integer_widths = [0] * len(numeric)
+        self.fraction_widths = [0] * len(numeric)
+        if any(numeric):
+            for batch in iter_batches(rows, DEFAULT_BATCH_ROWS):
+                for columns, _, empty in transpose_rows(batch):
+                    for i, values in enumerate(columns[:len(numeric)]):
+                        cells = NumericColumns.join_column(values, empty) if numeric[i] else None
+                        if cells is not None:
+                            self.integer_widths[i], self.fraction_widths[i] = NumericColumns.measure(cells, self.integer_widths[i], self.fraction_widths[i])
+        self.decimals_measured = True
+
+    @staticmethod
+    def measure(cells: bytes, integer_width: int = 0, fraction_width: int = 0) -> tuple[int, int]:
+        """
+        Widen `integer_width` and `fraction_width` to fit the integer and fractional parts of the numbers among
+        some cells of a numeric column, joined by newlines.
+        """
+        if cells.translate(None, b"0123456789\n.-") == b"":
+            # With every digit and sign a 0, a cell has an integer part at least n wide if a line starts with n zeros,
+            # and a fractional part at least n wide if "." and n - 1 zeros appear. The cells are searched backwards,
+            # so that the searches skip ahead to the rarer newlines and points instead of stopping at every 0.
+            backwards = cells[::-1].translate(NumericColumns.NUMBER_CHARS_TO_ZEROS) + b"\n"
+            while b"0" * (integer_width + 1) + b"\n" in backwards:
+                integer_width += 1
+            while b"0" * fraction_width + b"." in backwards:
+                fraction_width += 1
+            return integer_width, fraction_width
+        # Signs, exponents, whitespace and missing values are measured cell by cell
+        integer_width = max(integer_width, max(map(len, NumericColumns.INTEGER_PART_PATTERN.findall(cells))))
+        fraction_width = max(fraction_width, max(map(len, NumericColumns.FRACTION_PATTERN.findall(cells)), default=0))
+        return integer_width, fraction_width
+
+    def merge(self, other: "NumericColumns"):
+        """
+        Combine with the classification of another part of the same input.
+        """
+        for i in range(len(other.candidates)):
+            if i >= len(self.candidates):
+                self.candidates.append(other.candidates[i])
+                self.has_numbers.append(other.has_numbers[i])
+            else:
+                self.candidates[i] = self.candidates[i] and other.candidates[i]
+                self.has_numbers[i] = self.has_numbers[i] or other.has_numbers[i]
+
+    def numeric(self) -> list[bool]:
+        """
+        Whether each column is numeric.
+        """
+        return [candidate and has_numbers for candidate, has_numbers in zip(self.candidates, self.has_numbers)]
+
+    def to_dict(self) -> dict:
+        return {"candidates": self.candidates, "has_numbers": self.has_numbers}
+
+    @staticmethod
+    def from_dict(values: dict) -> "NumericColumns":
+        numeric_columns = NumericColumns()
+        numeric_columns.candidates = list(values["candidates"])
+        numeric_columns.has_numbers = list(values["has_numbers"])
+        return numeric_columns
+
+
+def align_decimal(field: str, integer_width: int, fraction_width: int) -> str:
+    """
+    Pad a number so that its decimal point lines up with that of the other numbers of its column, whose widest
+    integer and fractional parts are `integer_width` and `fraction_width` wide (see `NumericColumns`).
+    Anything else is padded like an integer.
+    """
+    point = field.find(".")
+    if point < 0:
+        point = len(field)
+    return " " * (integer_width - point) + field + " " * (fraction_width - len(field) + point)
+
+
+def read_header(lines: Iterable[AnyStr], delimiter: str, encoding: str = DEFAULT_ENCODING) -> Union[list[str], None]:
+    """
+    Return the column names of an input: the fields of the last comment row before the first data row that has
+    as many columns as the first data row (see `FileLayout.is_header()`), or None if there is no such row.
+    Only the lines up to the first data row are read.
+    """
+    return scan_top(lines, delimiter, encoding).header_names()
+
+
+def scan_top(lines: Iterable[AnyStr], delimiter: str, encoding: str = DEFAULT_ENCODING) -> FileLayout:
+    """
+    Partial layout of an input from only the lines up to its first data row: the comment rows before it,
+    and its number of columns. The widths and the rows are left for the caller to fill in.
+    """
+    layout = FileLayout(delimiter)
+    tokenizer = RowTokenizer(lines, delimiter, encoding)
+    layout.comment_rows = tokenizer.comments
+    first_row = next(tokenizer, None)
+    layout.num_columns = len(first_row) if first_row is not None else 0
+    return layout
+
+
+class RowTokenizer:
+    """
+    Iterator that splits the lines of a CSV/TSV input into rows of fields. Every pass (measuring the columns,
+    rendering the rows, and the worker processes of both) tokenizes rows with this class, so they always agree
+    on where the columns of a row are, including for quoted fields that contain the delimiter or span several lines.
+
+    Lines without a double quote are split on the delimiter directly. Lines with one are parsed by the csv module,
+    which reads the following lines as well if a quoted field continues on them. Blank lines are skipped, and comment
+    lines are collected in `comments` as they are passed, so they can be shown in place.
+
+    For raw lines, `offset` is the number of bytes read so far, and `row_offset` is the byte offset (relative to
+    the first line) of the start of the last row returned, for indexing rows (see `RowIndex`).
+
+    If a `row_filter` is given, rows that don't match it are skipped, only its columns are returned, and
+    `first_num_fields` is the number of columns the first row had before it was filtered.
+
+    Parameters
+    ----------
+    lines : Iterable[AnyStr]
+        Lines of the input, either decoded or raw (e.g. from `CSVInput.lines()` or `CSVInput.raw_lines()`).
+    delimiter : str
+        The string that separates columns in the input.
+    encoding : str
+        Encoding used to decode raw lines.
+    measure_only : bool
+        If true, raw lines that are pure ASCII and contain no quotes are split without being decoded, so the
+        fields of those rows are bytes. Their lengths are still correct, which is all that measuring needs.
+    skip_comments : int
+        Number of comment lines to drop before collecting them (e.g. because `scan_layout()` already collected them).
+    keep_comments : bool
+        If false, drop all comment lines instead of collecting them.
+    row_filter : RowFilter
+        Columns and rows to return.
+
+    """
+
+    def __init__(self, lines: Iterable[AnyStr], delimiter: str, encoding: str = DEFAULT_ENCODING, measure_only: bool = False, skip_comments: int = 0, keep_comments: bool = True, row_filter: RowFilter = None):
+        self._lines = iter(lines)
+        self.delimiter = delimiter
+        self.encoding = encoding
+        self.row_filter = row_filter
+        # Conditions compare decoded values
+        self.measure_only = measure_only and (row_filter is None or len(row_filter.conditions) == 0)
+        self.first_num_fields: int = None
+        self._skip_comments = skip_comments
+        self._keep_comments = keep_comments
+        self._raw_delimiter = delimiter.encode(encoding)
+        self._raw_comment_char = COMMENT_CHAR.encode(encoding)
+        self.comments: list[str] = list()
+        self.offset = 0
+        self.row_offset = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> list[AnyStr]:
+        row_filter = self.row_filter
+        if row_filter is None:
+            return self._next_row()
+        while True:
+            row = self._next_row()
+            if self.first_num_fields is None:
+                self.first_num_fields = len(row)
+            if row_filter.matches(row):
+                return row_filter.project(row)
+
+    def _next_row(self) -> list[AnyStr]:
+        delimiter = self.delimiter
+        for line in self._lines:
+            self.row_offset = self.offset
+            self.offset += len(line)
+            if type(line) == bytes:
+                if line.startswith(self._raw_comment_char):
+                    self._add_comment(line.decode(self.encoding, "replace"))
+                    continue
+                stripped = line.strip()
+                if not stripped:
+                    continue
+                if self.measure_only and b'"' not in stripped and stripped.isascii():
+                    return stripped.split(self._raw_delimiter)
+                stripped = stripped.decode(self.encoding, "replace")
+            else:
+                if line.startswith(COMMENT_CHAR):
+                    self._add_comment(line)
+                    continue
+                stripped = line.strip()
+                if not stripped:
+                    continue
+            if '"' in stripped:
+                return next(csv.reader(self._record_lines(stripped), delimiter=delimiter))
+            return stripped.split(delimiter)
+        raise StopIteration
+
+    def _add_comment(self, line: str):
+        if self._skip_comments > 0:
+            self._skip_comments -= 1
+        elif self._keep_comments:
+            self.comments.append(line.strip())
+
+    def _record_lines(self, first_line: str) -> Generator[str, None, None]:
+        # The csv reader only asks for another line while it's inside a quoted field,
+        # so it takes exactly the lines of one record from the input. It only keeps the
+        # line breaks of a quoted field that are in the lines, so they all end with one.
+        yield first_line + "\n"
+        encoding = self.encoding
+        for line in self._lines:
+            self.offset += len(line)
+            if type(line) == bytes:
+                line = line.decode(encoding, "replace")
+            yield line.rstrip("\r\n") + "\n"
+
+
+def iter_batches(items: Iterable[Any], batch_size: int) -> Generator[list[Any], None, None]:
+    item_iter = iter(items)
+    while True:
+        batch = list(itertools.islice(item_iter, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def fit_row(row: list[str], max_widths: list[int]) -> list[str]:
+    """
+    Truncate the fields of a row that are wider than their column, marking the cut with `OVERFLOW_MARKER`.
+    Columns that aren't in `max_widths` yet are added to it with the width of their field.
+    """
+    for field in row[len(max_widths):]:
+        max_widths.append(display_width(field.strip()) or 2)
+    fitted: list[str] = list()
+    for i, field in enumerate(row):
+        trimmed_field = field.strip()
+        width = max_widths[i]
+        if display_width(trimmed_field) > width:
+            trimmed_field = truncate_to_width(trimmed_field, max(width - len(OVERFLOW_MARKER), 0)) + OVERFLOW_MARKER
+        fitted.append(trimmed_field)
+    return fitted
+
+
+def scan_layout(lines: Iterable[AnyStr], column_delimiter: str = None, encoding: str = DEFAULT_ENCODING, sniff_bytes: int = DEFAULT_SNIFF_BYTES, max_rows: int = None, keep_rows: bool = False, index_rows: int = None, row_filter: RowFilter = None, collect_stats: bool = False) -> FileLayout:
+    """
+    First pass of the streaming formatter: read the lines of a CSV/TSV file once and collect
+    the column delimiter, the per-column maximum widths and the comment rows, without keeping
+    any data rows around.
+
+    The lines may be either decoded strings or raw bytes (e.g. straight from a memory-mapped file).
+    Rows are split by `RowTokenizer`, the same as in the second pass. Raw lines are measured without
+    being decoded as long as they are pure ASCII and unquoted; only other lines, comment lines and
+    the delimiter sample are decoded.
+
+    Parameters
+    ----------
+    lines : Iterable[AnyStr]
+        Lines of the input file, e.g. from `CSVInput.lines()` or `CSVInput.raw_lines()`.
+    column_delimiter : str
+        The string that separates columns in the input. If not specified, it is guessed
+        from the first `sniff_bytes` of data (see `sniff_delimiter()` for a more thorough guess).
+    encoding : str
+        Encoding used to decode raw lines, when needed.
+    sniff_bytes : int
+        Approximate number of bytes of data to sample when guessing the delimiter.
+    max_rows : int
+        If given, stop after this many data rows and return a layout estimated from them,
+        with `complete` set to False if there was more input.
+    keep_rows : bool
+        If true, keep the tokenized rows in the layout, so `iter_formatted_lines()` doesn't tokenize them again.
+        Memory use then grows with the size of the input, so this is only meant for small inputs.
+    index_rows : int
+        If given, index the byte offset of every `index_rows`th data row in `row_index`, for jumping to a row
+        without reading the rows before it. Only for raw lines, which must start at the start of the input.
+    row_filter : RowFilter
+        If given, only measure (and count, keep and index) its columns of the rows that match it.
+    collect_stats : bool
+        If true, also summarize the values of each column in `column_stats` (see `ColumnStats`). Every field
+        is decoded then, so this is slower, but memory use still doesn't depend on the number of rows.
+
+    Returns
+    -------
+    FileLayout
+        The layout of the file, to be passed to `iter_formatted_lines()`.
+
+    """
+    line_iter = iter(lines)
+    delim = column_delimiter if good_string(column_delimiter) else None
+    if delim is None:
+        # Buffer just enough data lines to guess the delimiter, then scan them along with the rest
+        sample: list[AnyStr] = list()
+        sample_bytes = 0
+        for line in line_iter:
+            sample.append(line)
+            if type(line) == bytes:
+                line = line.decode(encoding, "replace")
+            if not line.startswith(COMMENT_CHAR):
+                sample_bytes += len(line) + 1
+                if sample_bytes >= sniff_bytes:
+                    break
+        delim = guess_delimiter(read_sample(sample, sniff_bytes, encoding))
+        line_iter = itertools.chain(sample, line_iter)
+    layout = scan_lines(line_iter, delim, encoding, max_rows, keep_rows, index_rows, row_filter, collect_stats)
+    return finish_layout(layout)
+
+
+def scan_lines(lines: Iterable[AnyStr], delimiter: str, encoding: str = DEFAULT_ENCODING, max_rows: int = None, keep_rows: bool = False, index_rows: int = None, row_filter: RowFilter = None, collect_stats: bool = False) -> FileLayout:
+    """
+    Measure the data rows and collect the comment rows of a run of lines, for `scan_layout()`.
+    The result doesn't account for header rows yet, see `finish_layout()`.
+    """
+    layout = FileLayout(delimiter)
+    layout.row_filter = row_filter
+    tokenizer = RowTokenizer(lines, delimiter, encoding, measure_only=not keep_rows and not collect_stats, row_filter=row_filter)
+    layout.comment_rows = tokenizer.comments
+    if keep_rows:
+        layout.rows = list()
+    if index_rows is not None:
+        layout.row_index = RowIndex()
+    if collect_stats:
+        layout.column_stats = list()
+    # Widths, numeric columns and statistics are worked out a batch of rows at a time, a column at a time
+    # (see `update_batch_widths()`, `NumericColumns` and `ColumnStats`)
+    batch: list[list[AnyStr]] = list()
+    widths = layout.max_widths
+    numeric_columns = layout.numeric_columns
+
+    def update_batch():
+        for columns, rows, empty in transpose_rows(batch):
+            update_batch_widths(widths, columns, rows)
+            numeric_columns.update_columns(columns, empty)
+        if collect_stats:
+            update_column_stats(layout.column_stats, batch)
+        batch.clear()
+
+    num_rows = 0
+    for fields in tokenizer:
+        if num_rows == 0:
+            layout.num_columns = len(fields)
+        elif num_rows == max_rows:
+            layout.complete = False
+            break
+        batch.append(fields)
+        if len(batch) == DEFAULT_BATCH_ROWS:
+            update_batch()
+        if keep_rows:
+            layout.rows.append(fields)
+        if index_rows is not None and num_rows % index_rows == 0:
+            layout.row_index.add(num_rows, tokenizer.row_offset)
+        num_rows += 1
+    layout.num_rows = num_rows
+    if len(batch) > 0:
+        update_batch()
+    if row_filter is not None:
+        # Headers are recognized by the column count of the input, not of the selection
+        layout.num_columns = tokenizer.first_num_fields or 0
+    return layout
+
+
+def merge_layouts(parts: list[FileLayout]) -> FileLayout:
+    """
+    Combine the layouts of consecutive parts of a file (from `scan_lines()`) into the layout of the whole file:
+    the element-wise maximum of the widths, all comment rows in order, the column count of the first data row,
+    the row indexes of all parts (if every part has one) with their row numbers counted from the start of the file,
+    the numeric columns of all parts, and the column statistics of all parts (if every part has them).
+    """
+    layout = FileLayout(parts[0].delimiter)
+    layout.row_filter = parts[0].row_filter
+    if all(part.row_index is not None for part in parts):
+        layout.row_index = RowIndex()
+    if all(part.column_stats is not None for part in parts):
+        layout.column_stats = list()
+    widths = layout.max_widths
+    for part in parts:
+        if layout.row_index is not None:
+            layout.row_index.extend(part.row_index, layout.num_rows)
+        for i, width in enumerate(part.max_widths):
+            if i >= len(widths):
+                widths.append(width)
+            elif width > widths[i]:
+                widths[i] = width
+        layout.numeric_columns.merge(part.numeric_columns)
+        if layout.column_stats is not None:
+            for i, column_stats in enumerate(part.column_stats):
+                if i >= len(layout.column_stats):
+                    layout.column_stats.append(column_stats)
+                else:
+                    layout.column_stats[i].merge(column_stats)
+        if layout.num_columns == 0:
+            layout.num_columns = part.num_columns
+        layout.num_rows += part.num_rows
+        layout.comment_rows.extend(part.comment_rows)
+    return layout
+
+
+def finish_layout(layout: FileLayout) -> FileLayout:
+    """
+    Final step of the first pass: widen the columns to fit any comment row that looks like a header.
+    """
+    logdbg("scan_layout: %s data rows, %s columns, %s comment rows", layout.num_rows, layout.num_columns, len(layout.comment_rows))
+
+    # A comment row with the same number of columns as the data is probably a header,
+    # so it should be considered when calculating the column widths
+    for i, comment_row in enumerate(layout.comment_rows):
+        if layout.is_header(comment_row):
+            logdbg("scan_layout: COL COUNT MATCH for comment #%s: %s", i, comment_row)
+            update_column_widths(layout.max_widths, layout.split_comment(comment_row))
+    logdbg("MAX_WIDTHS: %s", layout.max_widths)
+    return layout
+
+
+def stats_layout(layout: FileLayout, max_value_width: int = DEFAULT_STATS_VALUE_WIDTH) -> FileLayout:
+    """
+    Layout of a summary table of the columns of an input, from the `column_stats` of its layout: a row for each
+    column (named as in the header, or numbered from 1), with the values of `STATS_COLUMNS` as a header. The rows
+    are kept in the layout, so `iter_formatted_lines()` renders the table without reading any input.
+    Values are shown on one line, and cut to `max_value_width` characters.
+    """
+    def cell(value: str) -> str:
+        value = " ".join(value.split())
+        if display_width(value) > max_value_width:
+            value = truncate_to_width(value, max_value_width - len(OVERFLOW_MARKER)) + OVERFLOW_MARKER
+        return value
+
+    header: list[str] = None
+    for comment_row in layout.comment_rows:
+        if layout.is_header(comment_row):
+            header = [field.strip() for field in layout.split_comment(comment_row)]
+    selected_columns = layout.row_filter.columns if layout.row_filter is not None else []
+    table = FileLayout("\t")
+    table.rows = list()
+    for i, column_stats in enumerate(layout.column_stats or []):
+        if header is not None and i < len(header) and header[i] != "":
+            name = header[i]
+        else:
+            name = str(selected_columns[i] + 1 if i < len(selected_columns) else i + 1)
+        row = [cell(value) for value in [name] + column_stats.summary()]
+        update_column_widths(table.max_widths, row)
+        table.rows.append(row)
+    table.numeric_columns.update(table.rows)
+    table.num_rows = len(table.rows)
+    table.num_columns = len(STATS_COLUMNS)
+    table.comment_rows = [COMMENT_CHAR + "\t".join(STATS_COLUMNS)]
+    return finish_layout(table)
+
+
+def count_quotes(filename: str, start: int, end: int) -> int:
+    """
+    Count the double quote characters in a byte range of a file (run in a worker process by `scan_layout_parallel()`).
+    """
+    quotes = 0
+    with open(filename, 'rb') as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+        for pos in range(start, end, DEFAULT_CHUNK_SIZE):
+            quotes += mapping[pos:min(pos + DEFAULT_CHUNK_SIZE, end)].count(b'"')
+    return quotes
+
+
+def scan_range(filename: str, start: int, end: int, delimiter: str, encoding: str = DEFAULT_ENCODING, index_rows: int = None, row_filter: RowFilter = None, collect_stats: bool = False) -> FileLayout:
+    """
+    Run `scan_lines()` over the lines in a byte range of a file (run in a worker process by `scan_layout_parallel()`).
+    `start` and `end` must be at the start of a record. The offsets in the row index are offsets in the file.
+    """
+    def range_lines(mapping: mmap.mmap) -> Generator[bytes, None, None]:
+        mapping.seek(start)
+        while mapping.tell() < end:
+            yield mapping.readline()
+
+    with open(filename, 'rb') as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+        layout = scan_lines(range_lines(mapping), delimiter, encoding, index_rows=index_rows, row_filter=row_filter, collect_stats=collect_stats)
+    if layout.row_index is not None:
+        layout.row_index.offsets = [offset + start for offset in layout.row_index.offsets]
+    return layout
+
+
+def find_record_boundaries(csv_input: CSVInput, offsets: list[int], quote_counts: list[int]) -> list[int]:
+    """
+    Move each of the tentative split points in `offsets` (except the first and last) forward to the start
+    of the next record: the start of a line that isn't inside a quoted field spanning several lines.
+    `quote_counts[i]` is the number of double quotes between `offsets[i]` and `offsets[i + 1]`.
+    """
+    boundaries = [offsets[0]]
+    quotes_before = 0
+    with open(csv_input.filename, 'rb') as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+        end = offsets[-1]
+        for i in range(1, len(offsets) - 1):
+            quotes_before += quote_counts[i - 1]
+            pos = offsets[i]
+            quotes = quotes_before
+            # Walk forward a line at a time until the number of quotes before the line start is even
+            while pos < end:
+                newline = mapping.find(b"\n", pos, end)
+                if newline < 0:
+                    pos = end
+                    break
+                quotes += mapping[pos:newline].count(b'"')
+                pos = newline + 1
+                if quotes % 2 == 0:
+                    break
+            if pos > boundaries[-1]:
+                boundaries.append(pos)
+        if end > boundaries[-1]:
+            boundaries.append(end)
+    return boundaries
+
+
+def scan_layout_parallel(csv_input: CSVInput, column_delimiter: str, jobs: int = DEFAULT_JOBS, index_rows: int = None, row_filter: RowFilter = None, collect_stats: bool = False) -> FileLayout:
+    """
+    Same as `scan_layout()` for a regular file, but the file is split into byte ranges at record
+    boundaries and each range is measured in a worker process; the partial layouts are then merged.
+    Falls back to `scan_layout()` for input that can't be memory-mapped or is too small to be worth it.
+
+    Parameters
+    ----------
+    csv_input : CSVInput
+        The input to scan.
+    column_delimiter : str
+        The string that separates columns in the input (see `sniff_delimiter()`).
+    jobs : int
+        Number of worker processes to use.
+    index_rows : int
+        If given, index the rows, see `scan_layout()`.
+    row_filter : RowFilter
+        If given, only measure the rows and columns it selects, see `scan_layout()`.
+    collect_stats : bool
+        If true, also summarize the values of each column, see `scan_layout()`.
+
+    Returns
+    -------
+    FileLayout
+        The layout of the file, to be passed to `iter_formatted_lines()`.
+
+    """
+    file_size = os.path.getsize(csv_input.filename) if csv_input.use_mmap else 0
+    if jobs < 2 or file_size < DEFAULT_PARALLEL_SCAN_BYTES:
+        return scan_layout(csv_input.raw_lines(), column_delimiter, csv_input.encoding, index_rows=index_rows, row_filter=row_filter, collect_stats=collect_stats)
+
+    # Only needed with --jobs, so it isn't imported at start-up
+    import multiprocessing
+    num_ranges = jobs * 2
+    offsets = [file_size * i // num_ranges for i in range(num_ranges + 1)]
+    filename = csv_input.filename
+    with multiprocessing.Pool(jobs) as pool:
+        # Quotes are counted first, so that quoted fields containing newlines are never split between ranges
+        quote_counts = pool.starmap(count_quotes, [(filename, offsets[i], offsets[i + 1]) for i in range(num_ranges)])
+        boundaries = find_record_boundaries(csv_input, offsets, quote_counts)
+        logdbg("scan_layout_parallel: scanning %s ranges with %s processes", len(boundaries) - 1, jobs)
+        parts = pool.starmap(scan_range, [(filename, boundaries[i], boundaries[i + 1], column_delimiter, csv_input.encoding, index_rows, row_filter, collect_stats) for i in range(len(boundaries) - 1)])
+    return finish_layout(merge_layouts(parts))
+
+
+def decode_row(row: list[AnyStr], encoding: str = DEFAULT_ENCODING) -> list[str]:
+    return [field.decode(encoding, "replace") if type(field) == bytes else field for field in row]
+
+
+def select_tail(csv_input: CSVInput, delimiter: str, num_rows: int, row_filter: RowFilter = None) -> list[list[str]]:
+    """
+    Return the last `num_rows` data rows of an input. Regular files are read backwards from their end, a few
+    more lines at a time until there are enough rows; other input is read to its end, keeping only the last rows.
+    """
+    if not csv_input.seekable:
+        tokenizer = RowTokenizer(csv_input.raw_lines(), delimiter, csv_input.encoding, measure_only=True, keep_comments=False, row_filter=row_filter)
+        return [decode_row(row, csv_input.encoding) for row in deque(tokenizer, maxlen=num_rows)]
+
+    num_lines = num_rows + 1
+    while True:
+        offset = csv_input.tail_offset(num_lines)
+        lines = list(csv_input.raw_lines(offset))
+        # The lines may start inside a quoted field that spans several lines. A line starts a record if the
+        # number of quotes from there to the end of a (well-formed) file is even.
+        quotes = 0
+        first_line = len(lines)
+        for i in range(len(lines) - 1, -1, -1):
+            quotes += lines[i].count(b'"')
+            if quotes % 2 == 0:
+                first_line = i
+        tokenizer = RowTokenizer(lines[first_line:], delimiter, csv_input.encoding, keep_comments=False, row_filter=row_filter)
+        rows = deque(tokenizer, maxlen=num_rows)
+        if len(rows) == num_rows or offset == 0:
+            return list(rows)
+        num_lines *= 2
+
+
+def select_sample(lines: Iterable[AnyStr], delimiter: str, encoding: str = DEFAULT_ENCODING, num_rows: int = 1, row_filter: RowFilter = None, rng: random.Random = None) -> list[list[str]]:
+    """
+    Return a uniform random sample of `num_rows` data rows of an input, in input order, reading it once and
+    keeping only the sample in memory (reservoir sampling, with the skips of Li's "Algorithm L", so random
+    numbers are only drawn for the rows that make it into the sample).
+    """
+    rng = rng if rng is not None else random.Random()
+
+    def log_random() -> float:
+        # random() may return 0.0, which has no logarithm
+        return math.log(rng.random() or sys.float_info.min)
+
+    def skip(weight: float) -> int:
+        # Number of rows to skip before the next one that replaces a row of the sample
+        return int(log_random() / math.log1p(-min(weight, 1.0 - sys.float_info.epsilon)))
+
+    reservoir: list[tuple[int, list[AnyStr]]] = list()
+    weight = math.exp(log_random() / num_rows)
+    next_row = num_rows + skip(weight)
+    tokenizer = RowTokenizer(lines, delimiter, encoding, measure_only=True, keep_comments=False, row_filter=row_filter)
+    for i, row in enumerate(tokenizer):
+        if i < num_rows:
+            reservoir.append((i, row))
+        elif i == next_row:
+            reservoir[rng.randrange(num_rows)] = (i, row)
+            weight *= math.exp(log_random() / num_rows)
+            next_row += skip(weight) + 1
+    return [decode_row(row, encoding) for i, row in sorted(reservoir, key=lambda item: item[0])]
+
+
+def scan_selection(csv_input: CSVInput, delimiter: str, mode: str, num_rows: int, row_filter: RowFilter = None) -> FileLayout:
+    """
+    First pass for showing only some of the data rows of an input: the first (`SELECT_HEAD`), the last
+    (`SELECT_TAIL`) or a random sample (`SELECT_SAMPLE`) of `num_rows` rows. The selected rows are kept in
+    the layout, and the widths only fit them (and the header). Only the comment rows before the first data
+    row are kept. With `SELECT_HEAD`, only the lines up to the last selected row are read.
+
+    Parameters
+    ----------
+    csv_input : CSVInput
+        The input to select rows from.
+    delimiter : str
+        The string that separates columns in the input (see `sniff_delimiter()`).
+    mode : str
+        Which rows to select, see above.
+    num_rows : int
+        Number of rows to select.
+    row_filter : RowFilter
+        If given, select among the rows that match it, and only its columns.
+
+    Returns
+    -------
+    FileLayout
+        The layout of the selected rows, to be passed to `iter_formatted_lines()`.
+
+    """
+    encoding = csv_input.encoding
+    lines = csv_input.raw_lines()
+    layout = scan_top(lines, delimiter, encoding)
+    lines.close()
+    if mode == SELECT_TAIL:
+        rows = select_tail(csv_input, delimiter, num_rows, row_filter)
+    else:
+        lines = csv_input.raw_lines()
+        if mode == SELECT_SAMPLE:
+            rows = select_sample(lines, delimiter, encoding, num_rows, row_filter)
+        else:
+            rows = list(itertools.islice(RowTokenizer(lines, delimiter, encoding, keep_comments=False, row_filter=row_filter), num_rows))
+        lines.close()
+    layout.row_filter = row_filter
+    layout.rows = rows
+    layout.num_rows = len(rows)
+    for row in rows:
+        update_column_widths(layout.max_widths, row)
+    for batch in iter_batches(rows, DEFAULT_BATCH_ROWS):
+        layout.numeric_columns.update(batch)
+    return finish_layout(layout)
+
+
+def parse_sort_spec(spec: str) -> tuple[str, bool, bool]:
+    """
+    Split a sort order given as `COLUMN[:num][:desc]` into the column (a name or a number, see `RowFilter`),
+    whether to compare its values as numbers, and whether to sort in descending order.
+    """
+    parts = spec.split(":")
+    numeric = False
+    descending = False
+    while len(parts) > 1 and parts[-1].strip().lower() in ("num", "desc"):
+        flag = parts.pop().strip().lower()
+        numeric = numeric or flag == "num"
+        descending = descending or flag == "desc"
+    column = ":".join(parts)
+    if column.strip() == "":
+        alert = f"parse_sort_spec: expected COLUMN[:num][:desc], got '{spec}'"
+        logerr(alert)
+        raise TypeError(alert)
+    return column, numeric, descending
+
+
+def sort_key(column: int, numeric: bool = False, descending: bool = False) -> Callable[[list[str]], Any]:
+    """
+    Key function for sorting rows by the value of a column (empty for rows without that column).
+    Numeric values (finite, in ASCII digits) sort as numbers, before all the values that aren't numbers, which sort as text.
+    For a sort in `descending` order (reversed, see `SortedRows`), the values that aren't numbers still come last.
+    """
+    if not numeric:
+        def text_key(row: list[str]) -> str:
+            return row[column].strip() if column < len(row) else ""
+        return text_key
+
+    # Which group sorts first, before the whole order is reversed
+    numbers_group, others_group = (1, 0) if descending else (0, 1)
+
+    def numeric_key(row: list[str]) -> tuple[int, Union[float, str]]:
+        value = row[column].strip() if column < len(row) else ""
+        try:
+            number = float(value)
+        except ValueError:
+            return (others_group, value)
+        # float() also takes "nan", "inf", digits grouped like "1_000" and non-ASCII digits, which aren't numbers here
+        if not math.isfinite(number) or "_" in value or not value.isascii():
+            return (others_group, value)
+        return (numbers_group, number)
+    return numeric_key
+
+
+class SortedRows:
+    """
+    The data rows of an input in sorted order, for `scan_sorted()`. Rows are added in chunks, which are sorted
+    as they are added: the last chunk is kept in memory, and the others are spilled to temporary files.
+    Iterating merges the chunks, reading the spill files a batch of rows at a time, so memory use depends on
+    the size of a chunk, not of the input. It can be iterated any number of times (e.g. for every jump in the pager).
+    Rows that compare equal keep their input order.
+
+    Parameters
+    ----------
+    key : Callable[[list[str]], Any]
+        Sort key of a row, see `sort_key()`.
+    descending : bool
+        If true, sort in descending order.
+
+    """
+
+    def __init__(self, key: Callable[[list[str]], Any], descending: bool = False):
+        self.key = key
+        self.descending = descending
+        self._rows: list[list[str]] = list()
+        self._spill_directory: tempfile.TemporaryDirectory = None
+        self._spill_paths: list[str] = list()
+
+    def spill(self, rows: list[list[str]]):
+        """
+        Sort a chunk of rows and write it to a temporary file.
+        """
+        rows.sort(key=self.key, reverse=self.descending)
+        if self._spill_directory is None:
+            self._spill_directory = tempfile.TemporaryDirectory(prefix="csview-sort-")
+        path = os.path.join(self._spill_directory.name, f"{len(self._spill_paths)}.pickle")
+        with open(path, "wb") as handle:
+            for batch in iter_batches(rows, DEFAULT_SORT_SPILL_BATCH_ROWS):
+                pickle.dump(batch, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spill_paths.append(path)
+        logdbg("SortedRows: spilled %s rows to '%s'", len(rows), path)
+
+    def keep(self, rows: list[list[str]]):
+        """
+        Sort the last chunk of rows and keep it in memory.
+        """
+        rows.sort(key=self.key, reverse=self.descending)
+        self._rows = rows
+
+    def _read_spill(self, path: str) -> Generator[list[str], None, None]:
+        with open(path, "rb") as handle:
+            while True:
+                try:
+                    yield from pickle.load(handle)
+                except EOFError:
+                    return
+
+    def __iter__(self):
+        if len(self._spill_paths) == 0:
+            return iter(self._rows)
+        chunks = [self._read_spill(path) for path in self._spill_paths] + [self._rows]
+        return heapq.merge(*chunks, key=self.key, reverse=self.descending)
+
+    def close(self):
+        if self._spill_directory is not None:
+            self._spill_directory.cleanup()
+            self._spill_directory = None
+
+
+def scan_sorted(csv_input: CSVInput, delimiter: str, sort_column: int, numeric: bool = False, descending: bool = False, row_filter: RowFilter = None, memory_bytes: int = DEFAULT_SORT_MEMORY_BYTES) -> FileLayout:
+    """
+    First pass for showing the data rows of an input sorted by a column: measure the rows like `scan_layout()`,
+    and keep them in a `SortedRows` as the layout's `rows`, so the second pass renders them from there.
+    Inputs that take up more than `memory_bytes` are sorted in chunks of about that size, which are spilled
+    to temporary files and merged (an external merge sort). Comment rows (and so headers) are still output first.
+
+    Parameters
+    ----------
+    csv_input : CSVInput
+        The input to sort.
+    delimiter : str
+        The string that separates columns in the input (see `sniff_delimiter()`).
+    sort_column : int
+        Index of the column to sort by, in the rows returned by the tokenizer (i.e. after `row_filter`).
+    numeric : bool
+        If true, compare values as numbers (see `sort_key()`).
+    descending : bool
+        If true, sort in descending order.
+    row_filter : RowFilter
+        If given, only sort the rows and columns it selects.
+    memory_bytes : int
+        Bytes of input to sort in memory at a time.
+
+    Returns
+    -------
+    FileLayout
+        The layout of the input, with its rows in sorted order.
+
+    """
+    layout = FileLayout(delimiter)
+    layout.row_filter = row_filter
+    tokenizer = RowTokenizer(csv_input.raw_lines(), delimiter, csv_input.encoding, row_filter=row_filter)
+    layout.comment_rows = tokenizer.comments
+    sorted_rows = SortedRows(sort_key(sort_column, numeric, descending), descending)
+    widths = layout.max_widths
+    chunk: list[list[str]] = list()
+    chunk_start = 0
+    for fields in tokenizer:
+        if layout.num_rows == 0:
+            layout.num_columns = len(fields)
+        update_column_widths(widths, fields)
+        chunk.append(fields)
+        layout.num_rows += 1
+        if tokenizer.offset - chunk_start >= memory_bytes:
+            layout.numeric_columns.update(chunk)
+            sorted_rows.spill(chunk)
+            chunk = list()
+            chunk_start = tokenizer.offset
+    if len(chunk) > 0:
+        layout.numeric_columns.update(chunk)
+    sorted_rows.keep(chunk)
+    if row_filter is not None:
+        layout.num_columns = tokenizer.first_num_fields or 0
+    layout.rows = sorted_rows
+    return finish_layout(layout)
+
+
+class LayoutCache:
+    """
+    On-disk cache of the layouts of complete inputs (see `layout_cache_key()`), so that reopening an unchanged
+    file skips the delimiter sniffing and the width scan. Each entry is a small JSON file named after a hash of its key.
+    The modification time of an entry is updated whenever it is used, and when the entries take up more than
+    `max_bytes`, the least recently used ones are deleted.
+
+    The cache is only an optimization: if it can't be read or written, it is ignored (with a debug message).
+
+    Parameters
+    ----------
+    directory : str
+        Directory to keep the entries in. Created if needed.
+    max_bytes : int
+        Maximum total size of the entries.
+
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, key: str) -> Union[FileLayout, None]:
+        path = self._path(key)
+        layout = read_layout_file(path, key)
+        if layout is not None:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return layout
+
+    def put(self, key: str, layout: FileLayout):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError as e:
+            logdbg("LayoutCache: could not create '%s': %s", self.directory, e)
+            return
+        if write_layout_file(self._path(key), key, layout, self.max_bytes):
+            try:
+                self.evict()
+            except OSError as e:
+                logdbg("LayoutCache: could not evict entries: %s", e)
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache fits in `max_bytes`.
+        """
+        entries: list[tuple[float, int, str]] = list()
+        with os.scandir(self.directory) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.name.endswith(".json"):
+                    entry_stat = dir_entry.stat()
+                    entries.append((entry_stat.st_mtime, entry_stat.st_size, dir_entry.path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            logdbg("LayoutCache: evicting '%s'", path)
+            os.remove(path)
+            total_bytes -= size
+
+
+def read_layout_file(path: str, key: str) -> Union[FileLayout, None]:
+    """
+    Read a layout saved by `write_layout_file()`. Returns None if the file doesn't exist, can't be read,
+    or was saved with a different key (i.e. for another input, or an earlier version of it).
+    """
+    try:
+        with open(path, 'r', encoding="utf-8") as layout_file:
+            entry = json.load(layout_file)
+        if entry.get("key") != key:
+            logdbg("read_layout_file: '%s' is out of date", path)
+            return None
+        layout = FileLayout.from_dict(entry["layout"])
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        logdbg("read_layout_file: ignoring unreadable file '%s': %s", path, e)
+        return None
+    logdbg("read_layout_file: using saved layout from '%s'", path)
+    return layout
+
+
+def write_layout_file(path: str, key: str, layout: FileLayout, max_bytes: int = None) -> bool:
+    """
+    Save a layout, and the key identifying the input it belongs to, as JSON. The file is written under
+    a temporary name first, so other instances never see a partly written file. Nothing is written if it
+    would be larger than `max_bytes`. Returns true if the file was written.
+    """
+    entry = json.dumps({"key": key, "layout": layout.to_dict()})
+    if max_bytes is not None and len(entry) > max_bytes:
+        return False
+    temp_path: str = None
+    try:
+        with tempfile.NamedTemporaryFile('w', encoding="utf-8", dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp", delete=False) as layout_file:
+            temp_path = layout_file.name
+            layout_file.write(entry)
+        # Temporary files are only readable by their owner, the layout file gets the usual permissions
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0o666 & ~umask)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logdbg("write_layout_file: could not write '%s': %s", path, e)
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    return True
+
+
+def layout_cache_key(csv_input: CSVInput, column_delimiter: str = None, sniff_bytes: int = DEFAULT_SNIFF_BYTES, sniff_samples: int = DEFAULT_SNIFF_SAMPLES, columns: list[str] = None, conditions: list[str] = None) -> str:
+    """
+    Key that identifies the layout of an input in `LayoutCache`: the path, size and modification time of a file
+    (compressed or not), or a hash of the content of other input, plus the settings that the layout depends on
+    (including the `columns` and `conditions` of a `RowFilter`, as given).
+    """
+    if csv_input.is_file:
+        file_stat = os.stat(csv_input.filename)
+        identity = ["file", os.path.realpath(csv_input.filename), file_stat.st_size, file_stat.st_mtime_ns]
+    else:
+        identity = ["content", csv_input.content_hash()]
+    return json.dumps([VERSION, csv_input.encoding, column_delimiter, sniff_bytes, sniff_samples, columns or [], conditions or []] + identity)
+
+
+def iter_record_chunks(lines: Iterable[str], chunk_rows: int = DEFAULT_JOB_CHUNK_ROWS) -> Generator[list[str], None, None]:
+    """
+    Group the lines of records into lists of about `chunk_rows` lines that can be tokenized independently,
+    i.e. a chunk never ends inside a quoted field that continues on the next line.
+    Comment lines and blank lines between records are dropped.
+    """
+    chunk: list[str] = list()
+    in_quotes = False
+    for line in lines:
+        if not in_quotes and (line.startswith(COMMENT_CHAR) or line.strip() == ""):
+            continue
+        chunk.append(line)
+        if line.count('"') % 2 == 1:
+            in_quotes = not in_quotes
+        if not in_quotes and len(chunk) >= chunk_rows:
+            yield chunk
+            chunk = list()
+    if len(chunk) > 0:
+        yield chunk
+
+
+# Formatting settings of a worker process, set once by `init_format_worker()` instead of being sent with every chunk
+worker_format_args: tuple = None
+
+
+def init_format_worker(*format_args):
+    global worker_format_args
+    worker_format_args = format_args
+
+
+def format_rows_chunk(data_lines: list[str]) -> list[str]:
+    """
+    Format a chunk of data lines in a worker process, using the settings passed to `init_format_worker()`.
+    """
+    delimiter, row_filter, renderer, line_prefix = worker_format_args
+    render = renderer.render
+    return [line_prefix + render(row) for row in RowTokenizer(data_lines, delimiter, keep_comments=False, row_filter=row_filter)]
+
+
+def iter_formatted_lines(lines: Iterable[str], layout: FileLayout, output_separator: str = "\t", quote_empty: bool = False, left_padding: int = PADDING_LEFT, right_padding: int = PADDING_RIGHT, colors_bold: bool = DEFAULT_BOLD, plain_text: bool = DEFAULT_PLAIN_TEXT, overflow: str = OVERFLOW_WIDEN, page_rows: int = DEFAULT_PAGER_CHUNK_LINES, jobs: int = DEFAULT_JOBS, start_row: int = 0, lines_start_row: int = 0, columns: list[int] = None, align_numbers: bool = True, align_decimals: bool = False) -> Generator[str, None, None]:
+    """
+    Second pass of the streaming formatter: re-read the lines of a CSV/TSV file and yield
+    the formatted output one line at a time. Comment rows are output first, followed by the data rows.
+
+    Parameters
+    ----------
+    lines : Iterable[str]
+        Lines of the input file, e.g. from `CSVInput.lines()`.
+    layout : FileLayout
+        Layout of the file, as returned by `scan_layout()` for the same input.
+    output_separator : str
+        String to use to separate columns in the output. Defaults to tab character.
+    quote_empty : bool
+        If false, empty columns will be shown as empty strings (no output). If true, represent them as pairs of double quotes.
+    left_padding: int
+        Number of spaces to use to left-pad each column in the output.
+    right_padding: int
+        Number of spaces to use to right-pad each column in the output.
+    colors_bold: bool
+        If true, use bold colors. If false, use regular colors.
+    plain_text: bool
+        If true, don't colorize the output. If false, use the standard colors.
+    overflow: str
+        Only used if the layout is not complete (see `scan_layout()`), for cells wider than their estimated column.
+        With `OVERFLOW_WIDEN`, rows are laid out a page of `page_rows` rows at a time, and columns are widened
+        to fit every cell of the page. With `OVERFLOW_TRUNCATE`, such cells are truncated and marked instead.
+        Comments found after the sample are shown where they appear.
+    page_rows: int
+        Number of rows to lay out together when widening columns.
+    jobs: int
+        Number of worker processes to format rows with. Rows are sent to the workers in chunks and
+        the output is yielded in input order. Only used if the layout is complete.
+    start_row: int
+        Number of the first data row to output (0 is the first data row of the input). If it's not 0, only
+        the comment rows that look like headers are output before the data rows, and other comment rows
+        are output where they appear.
+    lines_start_row: int
+        Number of the data row that `lines` starts at, if it doesn't start at the beginning of the input
+        (e.g. when it starts at an offset from the layout's `row_index`). Must not be more than `start_row`.
+    columns: list[int]
+        If given, only output these columns of the data rows and headers (see `visible_columns()`), e.g. the ones
+        that fit on the screen. The rows are still tokenized in full, but the other cells are never formatted.
+    align_numbers: bool
+        If true, right-align the columns that the first pass found to hold numbers (see `NumericColumns`).
+    align_decimals: bool
+        If true, also line up the decimal points of the numbers in those columns, widening them if needed.
+
+    If the layout kept the rows tokenized by the first pass, they are rendered from there and `lines` isn't read.
+    If the layout has a `row_filter`, the rows are filtered the same way as in the first pass.
+
+    Returns
+    -------
+    Generator[str, None, None]
+        Yields the colorized and formatted version of each line in the input file.
+
+    """
+    numeric_columns = layout.numeric_columns if align_numbers else None
+    align_decimals = align_numbers and align_decimals
+    if align_decimals:
+        if not layout.numeric_columns.decimals_measured and layout.rows is None:
+            # The numbers are measured from the lines, which are then rendered
+            lines = list(lines)
+            layout.align_decimals(iter_data_rows(lines, layout, fit_widths=False))
+        else:
+            layout.align_decimals()
+    max_widths = layout.max_widths
+    # A filter may leave no rows (and no columns to measure) at all
+    if (max_widths is None or len(max_widths) == 0) and layout.row_filter is None:
+        alert = "Could not determine TSV/CSV dialect to use with input file"
+        logerr(alert)
+        exit_error(1)
+
+    # Check comments to see if there's a column-for-column match in one of them.
+    # If so, it's probably a header and we should colorize the columns to match.
+    comments_have_header = False
+    comment_char = colorize(COMMENT_CHAR + " ", color_comment, colors_bold, plain_text)
+    # Whether we should dim and/or underline pseudo-header columns
+    ph_dim = False
+    ph_ul = False
+    header_renderer = RowRenderer(max_widths, output_separator, quote_empty, left_padding, right_padding, colors_bold, plain_text, ph_dim, ph_ul, columns, numeric_columns)
+    for comment_row in layout.comment_rows:
+        if layout.is_header(comment_row):
+            # This comment row has identical number of columns as data does, we should color it
+            comments_have_header = True
+            yield comment_char + header_renderer.render(layout.split_comment(comment_row))
+        elif start_row == 0:
+            yield format_comment_row(comment_row, layout, output_separator, colors_bold, plain_text)
+
+    # We colorized a comment row as a header, so we need to add padding to the
+    # first column to match the "# " in front of the header row, or they will
+    # no longer align
+    first_col_left_padding = "  " if comments_have_header else ""
+    renderer = RowRenderer(max_widths, output_separator, quote_empty, left_padding, right_padding, colors_bold, plain_text, columns=columns, numeric_columns=numeric_columns, align_decimals=align_decimals)
+    render = renderer.render
+    if layout.complete and layout.rows is not None:
+        for row in itertools.islice(layout.rows, start_row, None):
+            yield first_col_left_padding + render(row)
+        return
+    lines = iter(lines)
+    if start_row > lines_start_row:
+        # Skip the rows before the start row (the tokenizer only reads as many lines as those rows take up)
+        for _ in itertools.islice(RowTokenizer(lines, layout.delimiter, keep_comments=False, row_filter=layout.row_filter), start_row - lines_start_row):
+            pass
+    if layout.complete and jobs > 1:
+        import multiprocessing
+        format_args = (layout.delimiter, layout.row_filter, renderer, first_col_left_padding)
+        with multiprocessing.Pool(jobs, init_format_worker, format_args) as pool:
+            # Keep only a few chunks in flight, so memory use doesn't depend on the size of the input
+            pending = deque()
+            for chunk in iter_record_chunks(lines):
+                pending.append(pool.apply_async(format_rows_chunk, (chunk,)))
+                if len(pending) >= jobs * 2:
+                    yield from pending.popleft().get()
+            while len(pending) > 0:
+                yield from pending.popleft().get()
+        return
+    if layout.complete:
+        for row in RowTokenizer(lines, layout.delimiter, keep_comments=False, row_filter=layout.row_filter):
+            yield first_col_left_padding + render(row)
+        return
+
+    # The widths are only an estimate, rows may not fit
+    data_lines = RowTokenizer(lines, layout.delimiter, skip_comments=len(layout.comment_rows) if start_row == 0 else 0, row_filter=layout.row_filter)
+    batch_size = max(1, page_rows) if overflow == OVERFLOW_WIDEN else 1
+    for page in iter_batches(data_lines, batch_size):
+        if overflow == OVERFLOW_WIDEN:
+            for row in page:
+                update_column_widths(max_widths, row)
+        else:
+            page = [fit_row(row, max_widths) for row in page]
+        renderer.refresh()
+        # Comments read while getting this page's rows came before (or among) them in the input
+        for comment_row in data_lines.comments:
+            yield format_comment_row(comment_row, layout, output_separator, colors_bold, plain_text)
+        data_lines.comments.clear()
+        for row in page:
+            yield first_col_left_padding + render(row)
+    for comment_row in data_lines.comments:
+        yield format_comment_row(comment_row, layout, output_separator, colors_bold, plain_text)
+
+
+def format_comment_row(comment_row: str, layout: FileLayout, output_separator: str = "\t", colors_bold: bool = DEFAULT_BOLD, plain_text: bool = DEFAULT_PLAIN_TEXT) -> str:
+    """
+    Format a comment row that isn't a header: color it as a comment, with its delimiters replaced by the output separator.
+    """
+    comment_row_text = COMMENT_CHAR + " " + output_separator.join(comment_row.strip(COMMENT_CHAR).strip().split(layout.delimiter))
+    return colorize(comment_row_text.strip(), color_comment, colors_bold, plain_text, False, False)
+
+
+class RowWriter:
+    """
+    Base class of the writers that output a table in a format other than the colorized table, e.g. for other
+    programs to read (see `OUTPUT_WRITERS`). The rows are formatted and written to the stream a block at a time,
+    so the output is never held in memory as a whole.
+
+    Subclasses implement `format_row()`, and `format_header()` if the format has a header (`has_header`).
+
+    Parameters
+    ----------
+    stream: TextIO
+        Where to write the output, e.g. `sys.stdout`.
+    max_widths: list[int]
+        A list of integers where each element is the maximum width of the corresponding CSV/TSV column.
+    header: list[str]
+        The column names, or None if the input has no header (see `FileLayout.header_names()`).
+    output_separator : str
+        String to use to separate columns, in formats that pad their columns to a width.
+    numeric_columns: NumericColumns
+        If given, the columns it found to be numeric are right-aligned (in formats that align their columns).
+    align_decimals: bool
+        If true, also line up the decimal points of the numbers in those columns (see `align_decimal()`).
+    block_rows: int
+        Number of rows to write at a time. Use 1 for rows that trickle in, to pass each one on right away.
+
+    """
+
+    has_header = True
+    # Whether cells must fit in their column, i.e. have to be truncated if the widths are only an estimate
+    fit_widths = True
+
+    def __init__(self, stream: TextIO, max_widths: list[int], header: list[str] = None, output_separator: str = DEFAULT_SEPARATOR, numeric_columns: "NumericColumns" = None, align_decimals: bool = False, block_rows: int = DEFAULT_BATCH_ROWS):
+        self.stream = stream
+        self.max_widths = max_widths
+        self.header = header
+        self.output_separator = output_separator
+        numeric = numeric_columns.numeric() if numeric_columns is not None else []
+        self.align_right = [i < len(numeric) and numeric[i] for i in range(len(max_widths))]
+        self.numeric_columns = numeric_columns
+        self.align_decimals = align_decimals
+        self.block_rows = max(1, block_rows)
+
+    def format_header(self, header: list[str]) -> str:
+        """
+        Text of the header, with a line break at the end.
+        """
+        return ""
+
+    def format_row(self, row: list[str]) -> str:
+        """
+        Text of a data row, with a line break at the end.
+        """
+        raise NotImplementedError
+
+    def write(self, rows: Iterable[list[str]]):
+        """
+        Write the header (if the format has one) and the rows.
+        """
+        write = self.stream.write
+        if self.has_header:
+            write(self.format_header(self.header))
+        format_row = self.format_row
+        for block in iter_batches(rows, self.block_rows):
+            write("".join(map(format_row, block)))
+
+
+class FixedWidthWriter(RowWriter):
+    """
+    Fixed-width text: the data rows only, without colors, with every cell padded to the width of its column
+    (so each column starts at the same position on every line) and the columns separated by the output separator.
+    Rows are rendered by a `RowRenderer`, the same way as in the table.
+    """
+
+    has_header = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._renderer = RowRenderer(self.max_widths, self.output_separator, False, 0, 0, plain_text=True, numeric_columns=self.numeric_columns, align_decimals=self.align_decimals)
+
+    def format_row(self, row: list[str]) -> str:
+        return self._renderer.render(row) + "\n"
+
+
+class MarkdownWriter(RowWriter):
+    """
+    Markdown (GitHub Flavored Markdown) table, with its columns padded so that it also lines up as text.
+    Numeric columns are right-aligned. If the input has no header, the columns are numbered from 1.
+    Pipes in cells are escaped, and line breaks (in quoted fields) become `<br>`.
+    """
+
+    ESCAPES = str.maketrans({"|": "\\|", "\n": "<br>", "\r": None})
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.header is None:
+            self.header = [str(i + 1) for i in range(len(self.max_widths))]
+        self._widths = [max(3, width, display_width(self.header[i].translate(self.ESCAPES)) if i < len(self.header) else 0) for i, width in enumerate(self.max_widths)]
+        self._template = "| " + " | ".join("{:" + (">" if align_right else "<") + str(width) + "}" for width, align_right in zip(self._widths, self.align_right)) + " |\n"
+
+    def format_header(self, header: list[str]) -> str:
+        rule = "| " + " | ".join("-" * (width - 1) + ":" if align_right else "-" * width for width, align_right in zip(self._widths, self.align_right)) + " |\n"
+        return self._format_cells([name.translate(self.ESCAPES) for name in header]) + rule
+
+    def format_row(self, row: list[str]) -> str:
+        escapes = self.ESCAPES
+        return self._format_cells([field.translate(escapes) if "|" in field or "\n" in field else field for field in map(str.strip, row)])
+
+    def _format_cells(self, cells: list[str]) -> str:
+        widths = self._widths
+        num_widths = len(widths)
+        if len(cells) < num_widths:
+            cells += [""] * (num_widths - len(cells))
+        if len(cells) == num_widths:
+            line = self._template.format(*cells)
+            # The template pads by length, which is only the display width for ASCII text
+            if line.isascii():
+                return line
+        align_right = self.align_right
+        return "| " + " | ".join(pad_to_width(cell, widths[i], align_right[i]) if i < num_widths else cell for i, cell in enumerate(cells)) + " |\n"
+
+
+class JSONLinesWriter(RowWriter):
+    """
+    JSON Lines: one JSON object per data row, with the column names from the header as keys (or the column numbers,
+    counted from 1, for columns without a unique name). The values are the cells as strings, without surrounding
+    whitespace, so nothing is lost in conversion. Cells missing from short rows are left out.
+    """
+
+    has_header = False
+    fit_widths = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._keys: list[str] = list()
+        for i, name in enumerate(self.header or []):
+            self._keys.append(name if name != "" and name not in self._keys else str(i + 1))
+        self._template = ""
+        self.refresh()
+
+    def refresh(self):
+        """
+        Rebuild the template for rows with one cell per key, made of the keys already encoded as JSON,
+        so that only the values have to be encoded for each row.
+        """
+        self._template = "{" + ", ".join(json.dumps(key).replace("%", "%%") + ": %s" for key in self._keys) + "}\n"
+
+    def format_row(self, row: list[str]) -> str:
+        keys = self._keys
+        if len(row) == len(keys):
+            return self._template % tuple(map(encode_json_string, map(str.strip, row)))
+        if len(row) > len(keys):
+            keys.extend(str(i + 1) for i in range(len(keys), len(row)))
+            self.refresh()
+        return json.dumps(dict(zip(keys, map(str.strip, row)))) + "\n"
+
+
+# Writers of the output formats other than the table, by the name given to --output-format
+OUTPUT_WRITERS: dict[str, Type[RowWriter]] = {
+    OUTPUT_MARKDOWN: MarkdownWriter,
+    OUTPUT_FIXED: FixedWidthWriter,
+    OUTPUT_JSONL: JSONLinesWriter,
+}
+
+
+def iter_data_rows(lines: Iterable[str], layout: FileLayout, start_row: int = 0, lines_start_row: int = 0, fit_widths: bool = True) -> Generator[list[str], None, None]:
+    """
+    Second pass without the formatting: yield the data rows of the input from `start_row` on, filtered the same
+    way as in the first pass, or the rows the layout kept (see `iter_formatted_lines()` for the parameters).
+    If the layout is not complete and `fit_widths` is true, cells wider than their column are truncated (see `fit_row()`).
+    """
+    if layout.complete and layout.rows is not None:
+        yield from itertools.islice(layout.rows, start_row, None)
+        return
+    rows = RowTokenizer(lines, layout.delimiter, keep_comments=False, row_filter=layout.row_filter)
+    if start_row > lines_start_row:
+        rows = itertools.islice(rows, start_row - lines_start_row, None)
+    if not layout.complete and fit_widths:
+        max_widths = layout.max_widths
+        rows = (fit_row(row, max_widths) for row in rows)
+    yield from rows
+
+
+def write_layout(lines: Iterable[str], layout: FileLayout, output_format: str, stream: TextIO = None, output_separator: str = DEFAULT_SEPARATOR, align_numbers: bool = True, align_decimals: bool = False, start_row: int = 0, lines_start_row: int = 0, block_rows: int = DEFAULT_BATCH_ROWS):
+    """
+    Second pass for the output formats other than the table: re-read the lines of a CSV/TSV file and write
+    the rows to `stream` (standard output by default) with the writer of `output_format` (see `OUTPUT_WRITERS`),
+    a block of `block_rows` rows at a time. Comment rows other than the header are left out.
+    The other parameters are the same as for `iter_formatted_lines()`.
+    """
+    writer_class = OUTPUT_WRITERS.get(output_format)
+    if writer_class is None:
+        alert = f"write_layout: unknown output format '{output_format}', expected one of: {', '.join(OUTPUT_WRITERS)}"
+        logerr(alert)
+        raise TypeError(alert)
+    align_decimals = align_numbers and align_decimals
+    if align_decimals:
+        if not layout.numeric_columns.decimals_measured and layout.rows is None:
+            # The numbers are measured from the lines, which are then written
+            lines = list(lines)
+            layout.align_decimals(iter_data_rows(lines, layout, fit_widths=False))
+        else:
+            layout.align_decimals()
+    numeric_columns = layout.numeric_columns if align_numbers else None
+    writer = writer_class(stream if stream is not None else sys.stdout, layout.max_widths or [], layout.header_names(), output_separator, numeric_columns, align_decimals, block_rows)
+    writer.write(iter_data_rows(lines, layout, start_row, lines_start_row, writer.fit_widths))
+
+
 def format_file(file_contents: str, output_separator: str = "\t", quote_empty: bool = False, column_delimiter: str = None, left_padding: int = PADDING_LEFT, right_padding: int = PADDING_RIGHT, colors_bold: bool = DEFAULT_BOLD, plain_text: bool = DEFAULT_PLAIN_TEXT) -> list[str]:
     """
     Primary function for formatting CSV/TSV file contents.
@@ -430,6 +3012,9 @@ def format_file(file_contents: str, output_separator: str = "\t", quote_empty: b
     - Column values will be colored individually for visual distinctiveness
     Specifics will be controlled by the function parameters.
 
+    This is a convenience wrapper around `scan_layout()` and `iter_formatted_lines()` for content
+    that is already in memory. For large files, use those with a `CSVInput` instead.
+
     Parameters
     ----------
     file_contents : str
@@ -455,125 +3040,291 @@ def format_file(file_contents: str, output_separator: str = "\t", quote_empty: b
         A list of strings where each element is the colorized and formatted version of one line in the input file.
 
     """
-    max_widths: list[int] = None
-    delim = column_delimiter if good_string(column_delimiter) else None
-    if delim is None:
-        delim = guess_delimiter(file_contents)
-    logdbg(f"BOLD COLORS: {colors_bold}")
-    logdbg(f"DETECTED DELIMITER: '{delim}'")
-    comments = get_comments(file_contents)
-    data = get_data_lines(file_contents)
-    comments = comments.strip()
-    data = data.strip()
-    comment_lines = comments.split("\n")
-    data_rows = data.split("\n")
-    # for line in comment_lines:
-    #     print(colorize(line.strip(), color_comment))
-    # print(colorize(comments, color_comment))
-    comments: list[str] = list(comment_lines)
-    output_comments: list[str] = list()
-    output_data: list[str] = list()
-    output: list[str] = list()
-    # for comment_line in comment_lines:
-    #     comments.append(colorize(comment_line.strip(), color_comment, colors_bold, plain_text))
-
-    max_widths = get_max_widths(file_contents, delim)
-
-    reader = csv.reader(data_rows, delimiter=delim)
-
-    num_columns = 0
-    if reader is not None and max_widths is not None and len(max_widths) > 0:
-        for i, row in enumerate(reader):
-            if i == 0:
-                num_columns = len(row)
-            row_output = colorize_row(row, max_widths, quote_empty, left_padding, right_padding, colors_bold, plain_text)
-            output_data.append(output_separator.join(row_output))
+    logdbg("BOLD COLORS: %s", colors_bold)
+    file_lines = file_contents.split("\n")
+    layout = scan_layout(file_lines, column_delimiter, keep_rows=True)
+    logdbg("DETECTED DELIMITER: '%s'", layout.delimiter)
+    return list(iter_formatted_lines(file_lines, layout, output_separator, quote_empty, left_padding, right_padding, colors_bold, plain_text))
 
-    else:
-        alert = "Could not determine TSV/CSV dialect to use with input file"
+
+def generate_paged_content(file_lines: list[str]) -> str:
+    """
+    Join formatted lines into a single string for display in the pager all at once.
+    Prefer `CSVPagerSource`, which formats lines as the pager needs them.
+    """
+    if file_lines is None or not isinstance(file_lines, list):
+        alert = f"generate_paged_content: must provide list of strings representing lines in file"
         logerr(alert)
-        exit_error(1)
+        raise TypeError(alert)
 
-    comments_have_header = False
-    if num_columns > 0 and len(comments) > 0:
-        # Check comments to see if there's a column-for-column match in one of them.
-        # If so, it's probably a header and we should colorize the columns to match.
-        # header_rows = list(map(lambda line: line.strip(), list(filter(lambda line: line == '' or line[0] == '#', file_lines))))
-        cmt_char = "# "
-        comment_char = colorize(cmt_char, color_comment, colors_bold, plain_text)
-        uncommented = list(map(lambda line: line.strip('#').strip(), comments))
-        splits = list(map(lambda line: line.split(delim), uncommented))
-
-        # Whether we should dim and/or underline pseudo-header columns
-        ph_dim = False
-        ph_ul = False
-        for row in splits:
-            if len(row) == num_columns:
-                # This comment row has identical number of columns as data does, we should color it
-                comments_have_header = True
-                color_comment_row = colorize_row(row, max_widths, quote_empty, left_padding, right_padding, colors_bold, plain_text, ph_dim, ph_ul)
-                row_text = comment_char + output_separator.join(color_comment_row)
-                output_comments.append(row_text)
-            else:
-                # This comment row doesn't match data rows, color it as a comment
-                comment_row_text = cmt_char + output_separator.join(row)
-                output_comments.append(colorize(comment_row_text.strip(), color_comment, colors_bold, plain_text, False, False))
-
-    if comments_have_header:
-        # We colorized a comment row as a header, so we need to add padding to the
-        # first column to match the "# " in front of the header row, or they will
-        # no longer align
-        first_col_left_padding = "  "
-        output_data = list(map(lambda line: first_col_left_padding + line, output_data))
-
-    # Join comment and data rows into one big output list
-    for cmt_row in output_comments:
-        output.append(cmt_row)
-    for data_row in output_data:
-        output.append(data_row)
+    return "".join(file_line + "\n" for file_line in file_lines)
 
-    return output
 
+class CSVPagerSource:
+    """
+    Lazy pypager source for formatted CSV/TSV lines.
+    It implements pypager's `Source` interface without subclassing it, so that pypager only has to be imported
+    (by `import_pager()`, which must be called before using this class) if the pager actually runs.
+
+    The pager asks for more content only when the bottom of what it already has comes into view,
+    so lines are pulled from `formatted_lines` (normally the `iter_formatted_lines()` generator)
+    a chunk at a time, and only those lines are colorized and parsed into prompt_toolkit fragments.
+    The time until the first screen is drawn is therefore independent of the size of the file.
+    Each line is rendered once: the pager keeps the fragments it has been given.
+
+    Parameters
+    ----------
+    formatted_lines : Iterable[str]
+        Formatted (possibly ANSI-colored) output lines.
+    name : str
+        Name of the source shown by the pager.
+    chunk_lines : int
+        Number of lines to render each time the pager asks for more content.
+    start_row : int
+        Number of the data row that `formatted_lines` starts at.
+    first_column : int
+        Column that `formatted_lines` is scrolled sideways to, see `visible_columns()`.
+    leading_lines : int
+        Number of lines (headers and comments) before the first data row in `formatted_lines`.
+
+    The last three tell the key bindings that replace the source (see `add_jump_key_bindings()`) where it is in the input.
 
-def generator_paged_content(file_lines: list[str]) -> Generator[str, None, None]:
     """
-    This is a function that generates content on the fly.
-    It's called when the pager needs to display more content.
 
-    This should yield prompt_toolkit `(style_string, text)` tuples.
+    # No syntax highlighting, the lines are already colored
+    lexer = None
+
+    def __init__(self, formatted_lines: Iterable[str], name: str = "", chunk_lines: int = DEFAULT_PAGER_CHUNK_LINES, start_row: int = 0, first_column: int = 0, leading_lines: int = 0):
+        self.name = name
+        self.start_row = start_row
+        self.first_column = first_column
+        self.leading_lines = leading_lines
+        self.chunk_lines = max(1, chunk_lines)
+        self._lines = iter(formatted_lines)
+        self._eof = False
+        # The pager may start a new reader thread while a previous one is still waiting for input
+        self._lock = threading.Lock()
+
+    def get_name(self) -> str:
+        return self.name
+
+    def eof(self) -> bool:
+        return self._eof
+
+    def read_chunk(self) -> "StyleAndTextTuples":
+        "Read data from input. Return a list of token/text tuples."
+        fragments: "StyleAndTextTuples" = []
+        with self._lock:
+            for line in itertools.islice(self._lines, self.chunk_lines):
+                fragments.extend(to_formatted_text(ANSI(line + "\n")))
+            if len(fragments) == 0:
+                self._eof = True
+        return explode_text_fragments(fragments)
+
+    def close(self):
+        # Wait for a chunk that is being read to be finished, then stop reading
+        with self._lock:
+            self._eof = True
+            if hasattr(self._lines, "close"):
+                self._lines.close()
+
+
+def resolve_row_position(position: str, num_rows: int, window_rows: int) -> int:
     """
-    if file_lines is None or not isinstance(file_lines, list):
-        alert = f"generator_paged_content: must provide list of strings representing lines in file"
+    Turn a row position given by the user into the number of a data row (0 is the first data row):
+    a row number counted from 1, "end" for the last `window_rows` rows, or a percentage like "50%".
+    """
+    position = position.strip().lower()
+    if position == "end":
+        row = num_rows - window_rows
+    elif position.endswith("%") and position[:-1].isdigit():
+        row = num_rows * int(position[:-1]) // 100
+    elif position.isdigit():
+        row = int(position) - 1
+    else:
+        alert = f"resolve_row_position: expected a row number, 'end' or a percentage, got '{position}'"
         logerr(alert)
         raise TypeError(alert)
+    return max(0, min(row, num_rows - 1))
+
 
-    for file_line in file_lines:
-        out = ("", file_line)
-        yield [out]
-    # counter = 0
-    # while True:
-    #     # yield [("", 'line: %i\n' % counter)]
-    #     yield [()]
-    #     counter += 1
+def replace_pager_source(pager: "Pager", source: CSVPagerSource):
+    """
+    Show `source` in the pager instead of the current source, which is closed.
+    """
+    old_source = pager.current_source
+    pager.add_source(source)
+    pager.sources.remove(old_source)
+    pager.current_source_index = pager.sources.index(source)
+    old_source.close()
 
 
-def generate_paged_content(file_lines: list[str]) -> str:
+def viewing_rows_condition(pager: "Pager") -> "Condition":
+    """
+    Filter for the key bindings that replace the pager's source: true while a `CSVPagerSource` is in view
+    (and not e.g. the help screen or the search prompt).
     """
-    This is a function that generates content on the fly.
-    It's called when the pager needs to display more content.
+    from prompt_toolkit.application import get_app
+    from prompt_toolkit.filters import Condition
 
-    This should yield prompt_toolkit `(style_string, text)` tuples.
+    @Condition
+    def viewing_rows() -> bool:
+        return get_app().layout.current_window == pager.current_source_info.window and isinstance(pager.current_source, CSVPagerSource)
+
+    return viewing_rows
+
+
+def add_jump_key_bindings(pager: "Pager", make_source: Callable[[int, int], CSVPagerSource], num_rows: int, window_rows: int):
     """
-    if file_lines is None or not isinstance(file_lines, list):
-        alert = f"generate_paged_content: must provide list of strings representing lines in file"
-        logerr(alert)
-        raise TypeError(alert)
+    Add less-style key bindings to the pager for jumping straight to any row of the input, instead of scrolling
+    through every row before it: `N g` (or `N <`) goes to row N, `g` to the first row, `G` (or `>`) to the end and
+    `N %` (or `N p`) to N percent of the way through. The pager only holds what has been read of its source,
+    so a jump replaces the current source with `make_source(row, first_column)`, which should show the rows
+    from `row` on, scrolled sideways like the current source.
+    """
+    from prompt_toolkit.key_binding import KeyBindings, merge_key_bindings
+
+    viewing_rows = viewing_rows_condition(pager)
+
+    def show_rows(row: int):
+        replace_pager_source(pager, make_source(max(0, min(row, num_rows - 1)), pager.current_source.first_column))
+
+    bindings = KeyBindings()
+
+    @bindings.add("g", filter=viewing_rows)
+    @bindings.add("<", filter=viewing_rows)
+    def _jump_to_row(event):
+        show_rows(event.arg - 1 if event.arg_present else 0)
+
+    @bindings.add("G", filter=viewing_rows)
+    @bindings.add(">", filter=viewing_rows)
+    def _jump_to_end(event):
+        show_rows(num_rows - window_rows)
+
+    @bindings.add("%", filter=viewing_rows)
+    @bindings.add("p", filter=viewing_rows)
+    def _jump_to_percent(event):
+        show_rows(num_rows * min(event.arg, 100) // 100 if event.arg_present else 0)
+
+    pager.application.key_bindings = merge_key_bindings([pager.application.key_bindings, bindings])
 
-    out: str = ""
-    for file_line in file_lines:
-        out += file_line
-        out += "\n"
-    return out
+
+def add_column_key_bindings(pager: "Pager", make_source: Callable[[int, int], CSVPagerSource], num_rows: int, num_columns: int, frozen_columns: int = 0):
+    """
+    Make the left and right arrow keys (and `ESC (`, `ESC )`) scroll the pager sideways by whole columns, for input
+    too wide for the screen: `N right` scrolls N columns. Instead of scrolling over full-width lines, the current source
+    is replaced with `make_source(row, first_column)`, which should only format the columns that fit on the screen
+    from `first_column` on (see `visible_columns()`), starting at the data row at the top of the screen.
+    The first `frozen_columns` columns always stay in view.
+    """
+    from prompt_toolkit.key_binding import KeyBindings, merge_key_bindings
+
+    viewing_rows = viewing_rows_condition(pager)
+
+    def scroll_columns(amount: int):
+        source = pager.current_source
+        first_column = max(frozen_columns, min(source.first_column + amount, num_columns - 1))
+        if first_column == source.first_column:
+            return
+        window = pager.current_source_info.window
+        top_line = window.render_info.first_visible_line() if window.render_info is not None else 0
+        row = source.start_row + max(0, top_line - source.leading_lines)
+        replace_pager_source(pager, make_source(max(0, min(row, num_rows - 1)), first_column))
+
+    bindings = KeyBindings()
+
+    @bindings.add("left", filter=viewing_rows)
+    @bindings.add("escape", "(", filter=viewing_rows)
+    def _scroll_left(event):
+        scroll_columns(-event.arg)
+
+    @bindings.add("right", filter=viewing_rows)
+    @bindings.add("escape", ")", filter=viewing_rows)
+    def _scroll_right(event):
+        scroll_columns(event.arg)
+
+    pager.application.key_bindings = merge_key_bindings([pager.application.key_bindings, bindings])
+
+
+class Profiler:
+    """
+    Per-stage measurements of a run, for `--profile`: the wall time, the CPU time (of this process and of the
+    worker processes that have finished), the peak memory use (RSS) so far, and the throughput in rows and bytes
+    per second. A stage is measured with `with profiler.stage(name) as record:`, and the block may set
+    `record["rows"]` and `record["bytes"]` to the amount of data that went through it.
+    A disabled profiler measures nothing, so the stages cost next to nothing without `--profile`.
+
+    Parameters
+    ----------
+    enabled : bool
+        If false, don't measure anything.
+
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stages: list[dict] = list()
+        self._resource = None
+        if enabled:
+            try:
+                import resource
+                self._resource = resource
+            except ImportError:
+                # Not available on Windows, where only this process's CPU time and no memory use is measured
+                pass
+
+    def _cpu_time(self) -> float:
+        if self._resource is None:
+            return time.process_time()
+        own = self._resource.getrusage(self._resource.RUSAGE_SELF)
+        children = self._resource.getrusage(self._resource.RUSAGE_CHILDREN)
+        return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+    def _peak_rss(self) -> Union[int, None]:
+        if self._resource is None:
+            return None
+        peak = max(self._resource.getrusage(self._resource.RUSAGE_SELF).ru_maxrss, self._resource.getrusage(self._resource.RUSAGE_CHILDREN).ru_maxrss)
+        # In bytes on macOS, in kilobytes elsewhere
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Generator[dict, None, None]:
+        record = {"stage": name}
+        if not self.enabled:
+            yield record
+            return
+        wall_start = time.perf_counter()
+        cpu_start = self._cpu_time()
+        try:
+            yield record
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            record["wall_s"] = wall_time
+            record["cpu_s"] = self._cpu_time() - cpu_start
+            record["peak_rss_bytes"] = self._peak_rss()
+            for unit in ("rows", "bytes"):
+                if unit in record:
+                    record[f"{unit}_per_s"] = record[unit] / wall_time if wall_time > 0 else None
+            self.stages.append(record)
+
+    def report(self, path: str = None):
+        """
+        Write the measurements as JSON to the file at `path`, or as a table to stderr if no path is given.
+        """
+        if not self.enabled:
+            return
+        if good_string(path):
+            with open(path, "w") as handle:
+                json.dump({"version": VERSION, "stages": self.stages}, handle, indent=2)
+            return
+
+        def number(value: Any, scale: float = 1, digits: int = 3) -> str:
+            return "-" if value is None else f"{value / scale:.{digits}f}"
+
+        label = colored("[PROFILE]", color_debug)
+        print(label, f"{'stage':<10} {'wall s':>9} {'cpu s':>9} {'peak MB':>9} {'rows/s':>12} {'MB/s':>9}", file=sys.stderr)
+        for record in self.stages:
+            print(label, f"{record['stage']:<10} {number(record['wall_s']):>9} {number(record['cpu_s']):>9} {number(record['peak_rss_bytes'], 1024 * 1024, 1):>9} {number(record.get('rows_per_s'), 1, 0):>12} {number(record.get('bytes_per_s'), 1024 * 1024, 1):>9}", file=sys.stderr)
 
 
 class UsageFormatter(argparse.HelpFormatter):
@@ -817,6 +3568,7 @@ if __name__ == "__main__":
     '''
 
     reading_from_stdin = False
+    init_colors()
 
     version_string = f"v{VERSION}"
     version_docstring = f"{PROGRAM_NAME} {version_string}"
@@ -843,14 +3595,36 @@ if __name__ == "__main__":
     positional_args.add_argument('input_file', nargs='?', help=colored("Input file path. If not provided, will attempt to read data from standard input.", COLOR_HELP))
     # query_args.add_argument('-i', '--input', required=False, type=str, dest="input_file", default=None, help=colored("Input TSV/CSV file", COLOR_HELP))
     input_args.add_argument('-D', '--delimiter', required=False, type=str, dest="delimiter", default=None, help=colored("Input delimiter: character used to separate columns in input, if input is not standard CSV/TSV format.", COLOR_HELP))
+    input_args.add_argument('--sniff-kb', required=False, type=int, dest="sniff_kb", default=DEFAULT_SNIFF_BYTES // 1024, help=colored(f"Kilobytes of data to sample when guessing the input delimiter (Default: {DEFAULT_SNIFF_BYTES // 1024}).", COLOR_HELP))
+    input_args.add_argument('--sniff-samples', required=False, type=int, dest="sniff_samples", default=DEFAULT_SNIFF_SAMPLES, help=colored(f"Number of extra samples to take from random places in the input file when guessing the delimiter (Default: {DEFAULT_SNIFF_SAMPLES}).", COLOR_HELP))
+    input_args.add_argument('-F', '--fast-start', required=False, type=int, nargs='?', const=DEFAULT_FAST_START_ROWS, dest="fast_start", default=None, help=colored(f"Start showing output right away, using column widths estimated from the first ROWS rows (Default: {DEFAULT_FAST_START_ROWS}). Wider cells found later widen their column in the pager, or are truncated with --print.", COLOR_HELP), metavar="ROWS")
+    input_args.add_argument('--no-cache', required=False, dest="no_cache", action='store_true', default=not DEFAULT_USE_CACHE, help=colored(f"Don't use the layout cache, which remembers the delimiter and column widths of input files of {DEFAULT_CACHE_MIN_BYTES // 1024 // 1024} MB or more so they open faster next time.", COLOR_HELP))
+    input_args.add_argument('--cache-mb', required=False, type=int, dest="cache_mb", default=DEFAULT_CACHE_BYTES // 1024 // 1024, help=colored(f"Maximum size of the layout cache in megabytes (Default: {DEFAULT_CACHE_BYTES // 1024 // 1024}). The least recently used entries are deleted first.", COLOR_HELP))
+    input_args.add_argument('-I', '--index', required=False, dest="save_index", action='store_true', default=False, help=colored(f"Save the layout and row index of the input file next to it (as FILE{INDEX_FILE_SUFFIX}), and use it instead of scanning the file again as long as the file doesn't change.", COLOR_HELP))
+    input_args.add_argument('-c', '--columns', required=False, type=str, dest="columns", default=None, help=colored("Only show these columns, in this order: a comma-separated list of column names (from the header) or numbers (counted from 1).", COLOR_HELP), metavar="COLUMNS")
+    input_args.add_argument('-w', '--where', required=False, type=str, dest="where", action='append', default=None, help=colored("Only show the rows where a column matches: COLUMN=VALUE, COLUMN!=VALUE, COLUMN~REGEX or COLUMN!~REGEX. Can be given more than once, and rows must match all of them.", COLOR_HELP), metavar="CONDITION")
+    input_args.add_argument('--sort', required=False, type=str, dest="sort", default=None, help=colored("Sort the data rows by a column, given by name or number: COLUMN, COLUMN:num to compare numbers, COLUMN:desc for descending order, or COLUMN:num:desc. With num, values that aren't numbers (including empty ones) come after the numbers in either order. Headers stay on top. Large inputs are sorted in chunks on disk.", COLOR_HELP), metavar="COLUMN")
+    input_args.add_argument('--head', required=False, type=int, dest="head", default=None, help=colored("Only show the first N data rows, reading no further into the input than needed.", COLOR_HELP), metavar="N")
+    input_args.add_argument('--tail', required=False, type=int, dest="tail", default=None, help=colored("Only show the last N data rows. Files are read backwards from their end.", COLOR_HELP), metavar="N")
+    input_args.add_argument('--sample', required=False, type=int, dest="sample", default=None, help=colored("Only show N data rows picked at random (in input order), reading the input once.", COLOR_HELP), metavar="N")
+    input_args.add_argument('-f', '--follow', required=False, dest="follow", action='store_true', default=False, help=colored("Keep showing rows as they are appended to the input file, like 'tail -f'.", COLOR_HELP))
+    output_args.add_argument('-J', '--jump', required=False, type=str, dest="jump", default=None, help=colored("Start at this data row: a row number, 'end', or a percentage like '50%%'. In the pager, 'N g', 'G' and 'N %%' jump to row N, the end and N percent.", COLOR_HELP), metavar="ROW")
+    output_args.add_argument('--freeze', required=False, type=int, dest="freeze", default=DEFAULT_FROZEN_COLUMNS, help=colored(f"Number of columns to keep in view when scrolling sideways in the pager, with the arrow keys, through input too wide for the screen (Default: {DEFAULT_FROZEN_COLUMNS}).", COLOR_HELP), metavar="N")
+    output_args.add_argument('--stats', required=False, dest="stats", action='store_true', default=False, help=colored("Show a summary of each column instead of the data: the type of its values (int, float, date or string), the number of values, of missing values and (approximately) of distinct values, and the smallest and largest value.", COLOR_HELP))
+    output_args.add_argument('--align-decimals', required=False, dest="align_decimals", action='store_true', default=False, help=colored("Line up the decimal points of the numbers in numeric columns.", COLOR_HELP))
+    output_args.add_argument('--left-align', required=False, dest="left_align", action='store_true', default=False, help=colored("Left-align all columns. By default, columns that only hold numbers are right-aligned.", COLOR_HELP))
     output_args.add_argument('-t', '--title-hide', required=False, dest="title_hide", action='store_true', default=DEFAULT_HIDE_TITLE, help=colored("Hide the title bar (don't show file name at top of pager).", COLOR_HELP))
     output_args.add_argument('-p', '--print', required=False, dest="print_output", action='store_true', default=DEFAULT_PRINT_OUTPUT, help=colored("Print output to terminal instead of displaying in pager.", COLOR_HELP))
+    output_args.add_argument('-o', '--output-format', required=False, type=str, dest="output_format", default=OUTPUT_TABLE, help=colored(f"Output format: {OUTPUT_TABLE} (Default), {OUTPUT_MARKDOWN} (a Markdown table), {OUTPUT_FIXED} (fixed-width text: data rows only, each column padded to its width) or {OUTPUT_JSONL} (JSON Lines: one object per row, keyed by the column names). Formats other than {OUTPUT_TABLE} are printed, without colors.", COLOR_HELP), metavar="FORMAT")
     output_args.add_argument('-q', '--quote-empty', required=False, dest="empty_quotes", action='store_true', default=DEFAULT_QUOTE_EMPTY, help=colored(f"Show empty columns as \"\" (Default: {DEFAULT_QUOTE_EMPTY}).", COLOR_HELP))
     output_args.add_argument('-b', '--bold', required=False, dest="bold_colors", action='store_true', default=DEFAULT_BOLD, help=colored(f"Use bold colors for columns (Default: {DEFAULT_BOLD}).", COLOR_HELP))
     output_args.add_argument('-n', '--no-color', required=False, dest="no_color", action='store_true', default=DEFAULT_PLAIN_TEXT, help=colored(f"Do not colorize output, only align columns (Default: {DEFAULT_PLAIN_TEXT}).", COLOR_HELP))
     output_args.add_argument('-s', '--separator', required=False, type=str, dest="separator", default=None, help=colored(description_separator, COLOR_HELP))
     output_args.add_argument('-r', '--right-pad', required=False, type=int, dest="padding_right", default=PADDING_RIGHT, help=colored(f"Number of spaces to add to the right of each column for padding. (Default: {PADDING_RIGHT}).", COLOR_HELP))
     output_args.add_argument('-l', '--left-pad', required=False, type=int, dest="padding_left", default=PADDING_LEFT, help=colored(f"Number of spaces to add to the left of each column for padding. (Default: {PADDING_LEFT}).", COLOR_HELP))
+    output_args.add_argument('-j', '--jobs', required=False, type=int, dest="jobs", default=DEFAULT_JOBS, help=colored(f"Number of processes to use to measure columns and format rows (Default: {DEFAULT_JOBS}). Mostly useful with --print on large files: rows are only formatted in parallel for inputs of at least {DEFAULT_PARALLEL_FORMAT_BYTES // (1024 * 1024)} MB, with at most one process per CPU.", COLOR_HELP))
+    meta_args.add_argument('--profile', required=False, dest="profile", action='store_true', default=False, help=colored("Measure the wall time, CPU time, peak memory use and throughput of each stage (reading, sniffing, scanning, formatting), and report them on stderr.", COLOR_HELP))
+    meta_args.add_argument('--profile-file', required=False, type=str, dest="profile_file", default=None, help=colored("With --profile, write the report to this file as JSON instead.", COLOR_HELP), metavar="FILE")
     meta_args.add_argument('-d', '--debug', required=False, dest="debug", action='store_true', help=colored("Show debug information and intermediate steps.", COLOR_HELP))
     meta_args.add_argument('-v', '--version', action='version', version=version_docstring, help=colored("Show program's version number and exit.", COLOR_HELP))
     meta_args.add_argument('-h', '--help', required=False, dest="show_help", action='store_true', help=colored("Show this help message and exit.", COLOR_HELP))
@@ -876,9 +3650,31 @@ if __name__ == "__main__":
     arg_pad_left = inpArgs.padding_left
     arg_title_hide = inpArgs.title_hide
     arg_print = inpArgs.print_output
+    arg_output_format = inpArgs.output_format
     arg_empty_quotes = inpArgs.empty_quotes
     arg_bold = inpArgs.bold_colors
     arg_no_color = inpArgs.no_color
+    arg_sniff_kb = inpArgs.sniff_kb
+    arg_fast_start = inpArgs.fast_start
+    arg_follow = inpArgs.follow
+    arg_jobs = inpArgs.jobs
+    arg_sniff_samples = inpArgs.sniff_samples
+    arg_no_cache = inpArgs.no_cache
+    arg_save_index = inpArgs.save_index
+    arg_jump = inpArgs.jump
+    arg_cache_mb = inpArgs.cache_mb
+    arg_columns = inpArgs.columns
+    arg_where = inpArgs.where
+    arg_head = inpArgs.head
+    arg_tail = inpArgs.tail
+    arg_sample = inpArgs.sample
+    arg_freeze = inpArgs.freeze
+    arg_sort = inpArgs.sort
+    arg_stats = inpArgs.stats
+    arg_align_decimals = inpArgs.align_decimals
+    arg_left_align = inpArgs.left_align
+    arg_profile = inpArgs.profile
+    arg_profile_file = inpArgs.profile_file
 
     if bad_string(arg_input):
         arg_input = inpArgs.input_file
@@ -899,39 +3695,233 @@ if __name__ == "__main__":
     bold_colors = arg_bold
     no_colors = arg_no_color
     empty_quotes = arg_empty_quotes
+    sniff_bytes = arg_sniff_kb * 1024 if type(arg_sniff_kb) == int and arg_sniff_kb > 0 else DEFAULT_SNIFF_BYTES
+    follow = arg_follow
+    jobs = arg_jobs if type(arg_jobs) == int and arg_jobs > 0 else DEFAULT_JOBS
+    fast_start_rows = arg_fast_start if type(arg_fast_start) == int and arg_fast_start > 0 else None
+    sniff_samples = arg_sniff_samples if type(arg_sniff_samples) == int and arg_sniff_samples > 0 else DEFAULT_SNIFF_SAMPLES
+    cache_bytes = arg_cache_mb * 1024 * 1024 if type(arg_cache_mb) == int and arg_cache_mb > 0 else DEFAULT_CACHE_BYTES
+    output_format = arg_output_format.strip().lower() if good_string(arg_output_format) else OUTPUT_TABLE
+    if output_format != OUTPUT_TABLE and output_format not in OUTPUT_WRITERS:
+        logerr(f"Unknown output format '{arg_output_format}', please use one of: {', '.join([OUTPUT_TABLE] + list(OUTPUT_WRITERS))}")
+        exit_error(1)
+    if output_format != OUTPUT_TABLE:
+        # The other formats are meant for files and other programs, not for the pager
+        print_output = True
+    jump = arg_jump if good_string(arg_jump) else None
+    if jump is not None and fast_start_rows is not None:
+        logwarn("--jump needs the whole input to be scanned first, ignoring --fast-start")
+        fast_start_rows = None
+    selections = [(mode, count) for mode, count in ((SELECT_HEAD, arg_head), (SELECT_TAIL, arg_tail), (SELECT_SAMPLE, arg_sample)) if type(count) == int]
+    if len(selections) > 1:
+        logerr("Please use only one of --head, --tail and --sample")
+        exit_error(1)
+    select_mode, select_rows = selections[0] if len(selections) > 0 else (None, None)
+    if select_mode is not None and select_rows < 1:
+        logerr(f"--{select_mode} needs a number of rows of at least 1")
+        exit_error(1)
+    sort_column, sort_numeric, sort_descending = None, False, False
+    if good_string(arg_sort):
+        try:
+            sort_column, sort_numeric, sort_descending = parse_sort_spec(arg_sort)
+        except TypeError:
+            exit_error(1)
+        if select_mode is not None:
+            logerr(f"Can't use --sort with --{select_mode}")
+            exit_error(1)
+    # Options that pick or reorder the rows, and have a first pass of their own
+    rows_option = f"--{select_mode}" if select_mode is not None else "--sort" if sort_column is not None else None
+    if rows_option is not None and fast_start_rows is not None:
+        # Only the selected rows are measured anyway
+        logwarn(f"Ignoring --fast-start with {rows_option}")
+        fast_start_rows = None
+    if rows_option is not None and follow:
+        logwarn(f"Can't follow the input with {rows_option}, ignoring --follow")
+        follow = False
+    show_stats = arg_stats
+    if show_stats and rows_option is not None:
+        logerr(f"Can't use --stats with {rows_option}")
+        exit_error(1)
+    if show_stats and fast_start_rows is not None:
+        logwarn("--stats needs the whole input to be scanned first, ignoring --fast-start")
+        fast_start_rows = None
+    if show_stats and follow:
+        logwarn("Can't follow the input with --stats, ignoring --follow")
+        follow = False
+    # Layouts estimated from a sample, or of input that keeps growing, aren't worth remembering.
+    # Column statistics aren't cached either, they're collected by the first pass every time
+    use_cache = not arg_no_cache and fast_start_rows is None and not follow and rows_option is None and not show_stats
+    save_index = arg_save_index and fast_start_rows is None and rows_option is None and not show_stats
+    filter_columns = [column for column in arg_columns.split(",") if column.strip() != ""] if good_string(arg_columns) else []
+    filter_conditions = [condition for condition in arg_where if good_string(condition)] if good_list(arg_where) else []
 
     # if debug:
     #     logging.basicConfig(level=logging.DEBUG)
     # else:
     #     logging.basicConfig(level=logging.WARNING)
 
-    csv_content = ""
+    profiler = Profiler(arg_profile or good_string(arg_profile_file))
+    csv_input: CSVInput = None
     file_name = "(STDIN)"
     pager_title_text = file_name
     if reading_from_stdin:
-        csv_content = sys.stdin.read()
+        csv_input = CSVInput(stream=sys.stdin.buffer)
     else:
         if not ntpath.exists(input_file):
             logerr(f"Could not read input file '{input_file}'")
             exit_error(1)
         else:
-            csv_content = get_file_contents(input_file)
-            file_name = os.path.basename(input_file)
-            pager_title_text = f"FILE: {file_name}"
+            with profiler.stage("open"):
+                csv_input = CSVInput(input_file)
+            if input_file != DEFAULT_INPUT:
+                file_name = os.path.basename(input_file)
+                pager_title_text = f"FILE: {file_name}"
+    if follow and csv_input.compression is not None:
+        logwarn("Can't follow compressed input, ignoring --follow")
+        follow = False
+
+    # First pass: delimiter, column widths, comments/header. Second pass: format rows as they're needed.
+    # The first pass is skipped if the layout of the same input is in the index file or the cache.
+    layout_cache: LayoutCache = None
+    cache_key: str = None
+    index_path: str = input_file + INDEX_FILE_SUFFIX if save_index and csv_input.is_file else None
+    layout: FileLayout = None
+    layout_from_index = False
+    if use_cache or index_path is not None:
+        with profiler.stage("cache"):
+            cache_key = layout_cache_key(csv_input, delimiter, sniff_bytes, sniff_samples, filter_columns, filter_conditions)
+            if index_path is not None:
+                layout = read_layout_file(index_path, cache_key)
+                layout_from_index = layout is not None
+            if use_cache and layout is None and csv_input.size() >= DEFAULT_CACHE_MIN_BYTES:
+                layout_cache = LayoutCache(max_bytes=cache_bytes)
+                layout = layout_cache.get(cache_key)
+
+    def make_row_filter(delimiter: str) -> Union[RowFilter, None]:
+        if len(filter_columns) == 0 and len(filter_conditions) == 0:
+            return None
+        # Only the lines up to the first data row are read to find the column names
+        header_lines = csv_input.raw_lines()
+        header = read_header(header_lines, delimiter, csv_input.encoding)
+        header_lines.close()
+        logdbg("FILTER HEADER: %s", header)
+        try:
+            return RowFilter(filter_columns, filter_conditions, header)
+        except TypeError:
+            exit_error(1)
 
-    colorized_lines: list[str] = None
-    colorized_output: str = ""
+    def sort_column_index(delimiter: str, row_filter: RowFilter) -> int:
+        header_lines = csv_input.raw_lines()
+        header = read_header(header_lines, delimiter, csv_input.encoding)
+        header_lines.close()
+        try:
+            column = RowFilter(header=header).column_index(sort_column)
+        except TypeError:
+            exit_error(1)
+        if row_filter is None or len(row_filter.columns) == 0:
+            return column
+        # The rows are sorted after the columns have been selected
+        if column not in row_filter.columns:
+            logerr(f"The column to sort by, '{sort_column}', must be one of the columns selected with --columns")
+            exit_error(1)
+        return row_filter.columns.index(column)
 
-    if good_string(delimiter):
-        colorized_lines = format_file(csv_content, separator, empty_quotes, delimiter, lpadding, rpadding, bold_colors, no_colors)
+    if layout is not None:
+        if index_path is not None and not layout_from_index:
+            # The layout came from the cache, the index file still has to be written
+            write_layout_file(index_path, cache_key, layout)
+        layout.row_filter = make_row_filter(layout.delimiter)
     else:
-        colorized_lines = format_file(csv_content, separator, empty_quotes, left_padding=lpadding, right_padding=rpadding, colors_bold=bold_colors, plain_text=no_colors)
-    if colorized_lines is not None and len(colorized_lines) > 0:
+        if bad_string(delimiter):
+            # With --head, don't wait for more lines than will be shown
+            sniff_lines = select_rows if select_mode == SELECT_HEAD else fast_start_rows
+            with profiler.stage("sniff"):
+                delimiter, delimiter_confidence = sniff_delimiter(csv_input, sniff_bytes, sniff_samples, sniff_lines)
+            logdbg("DETECTED DELIMITER: '%s' (confidence: %.0f%%)", delimiter, delimiter_confidence * 100)
+        row_filter = make_row_filter(delimiter)
+        # Small files are only tokenized once: the rows from the first pass are kept for the second
+        keep_rows = csv_input.seekable and fast_start_rows is None and not follow and not show_stats and os.path.getsize(input_file) <= DEFAULT_KEEP_ROWS_BYTES
+        index_rows = DEFAULT_INDEX_ROWS if not show_stats else None
+        with profiler.stage("scan") as profile_record:
+            if select_mode is not None:
+                layout = scan_selection(csv_input, delimiter, select_mode, select_rows, row_filter)
+            elif sort_column is not None:
+                layout = scan_sorted(csv_input, delimiter, sort_column_index(delimiter, row_filter), sort_numeric, sort_descending, row_filter)
+            elif jobs > 1 and fast_start_rows is None and not keep_rows:
+                layout = scan_layout_parallel(csv_input, delimiter, jobs, index_rows, row_filter, show_stats)
+            else:
+                layout = scan_layout(csv_input.raw_lines(), delimiter, csv_input.encoding, sniff_bytes, fast_start_rows, keep_rows, index_rows, row_filter, show_stats)
+            profile_record["rows"] = layout.num_rows
+            profile_record["bytes"] = csv_input.size()
+        if layout_cache is not None and layout.complete:
+            layout_cache.put(cache_key, layout)
+        if index_path is not None and layout.complete:
+            write_layout_file(index_path, cache_key, layout)
+    if show_stats:
+        # The summary is shown like any other table, instead of the input
+        layout = stats_layout(layout)
+    overflow = OVERFLOW_TRUNCATE if print_output else OVERFLOW_WIDEN
+    page_rows = DEFAULT_PAGER_CHUNK_LINES
+    if follow:
+        # More rows will keep coming: widen columns as needed and pass each row on as soon as it arrives
+        layout.complete = False
+        overflow = OVERFLOW_WIDEN
+        page_rows = 1
+
+    align_numbers = not arg_left_align
+    align_decimals = align_numbers and arg_align_decimals
+    if align_decimals:
+        # Before anything depends on the column widths. Unless the layout kept its rows, the numbers are measured
+        # from another read of the rows the layout was made from.
+        layout.align_decimals(None if layout.rows is not None else itertools.islice(iter_data_rows(csv_input.lines(), layout, fit_widths=False), layout.num_rows))
+
+    num_header_rows = sum(1 for comment_row in layout.comment_rows if layout.is_header(comment_row))
+    # Data rows are indented to line up with the "# " of the headers
+    line_prefix_width = 2 if num_header_rows > 0 else 0
+    frozen_columns = arg_freeze if type(arg_freeze) == int and arg_freeze > 0 else DEFAULT_FROZEN_COLUMNS
+    # Worker processes only format faster than this one when each has a CPU of its own, and when the input is
+    # large enough to make up for passing every chunk of lines to them and the rendered lines back
+    format_jobs = min(jobs, os.cpu_count() or 1) if csv_input.size() >= DEFAULT_PARALLEL_FORMAT_BYTES else 1
+    # The pager scrolls input that is too wide for the screen sideways a column at a time, and only formats the columns in view
+    scroll_columns = not print_output and not follow and len(visible_columns(layout.max_widths, 0, shutil.get_terminal_size().columns, 0, lpadding + rpadding, len(separator), line_prefix_width)) < len(layout.max_widths)
+
+    def format_from_row(start_row: int, first_column: int = frozen_columns) -> Generator[str, None, None]:
+        columns = visible_columns(layout.max_widths, first_column, shutil.get_terminal_size().columns, frozen_columns, lpadding + rpadding, len(separator), line_prefix_width) if scroll_columns else None
+        # Start reading at the nearest indexed row, instead of reading every row before the start row
+        lines_start_row, offset = layout.row_index.lookup(start_row) if layout.row_index is not None else (0, 0)
+        return iter_formatted_lines(csv_input.lines(offset, follow), layout, separator, empty_quotes, lpadding, rpadding, bold_colors, no_colors, overflow, page_rows, format_jobs, start_row, lines_start_row, columns, align_numbers, align_decimals)
+
+    # Rows that fit on the screen below the pager's title and status bars, and the header rows
+    window_rows = max(1, shutil.get_terminal_size().lines - 2 - num_header_rows)
+    first_row = resolve_row_position(jump, layout.num_rows, window_rows) if jump is not None and layout.num_rows > 0 else 0
+    if layout.num_rows > 0 or len(layout.comment_rows) > 0:
         if print_output:
+            colorized_lines = format_from_row(first_row) if output_format == OUTPUT_TABLE else None
             # Just dump output to terminal instead of showing in pager
-            print("\n".join(colorized_lines))
+            trickling = fast_start_rows is not None or follow
+            if trickling:
+                # Rows may be trickling in (e.g. from `tail -f`), pass each one on as soon as it's formatted
+                sys.stdout.reconfigure(line_buffering=True)
+            try:
+                with profiler.stage("format") as profile_record:
+                    if colorized_lines is not None:
+                        sys.stdout.writelines(line + "\n" for line in colorized_lines)
+                    else:
+                        lines_start_row, offset = layout.row_index.lookup(first_row) if layout.row_index is not None else (0, 0)
+                        write_layout(csv_input.lines(offset, follow), layout, output_format, sys.stdout, separator, align_numbers, align_decimals, first_row, lines_start_row, 1 if trickling else DEFAULT_BATCH_ROWS)
+                    sys.stdout.flush()
+                    profile_record["rows"] = max(0, layout.num_rows - first_row)
+            except BrokenPipeError:
+                # The output was closed early (e.g. piped to `head`): stop formatting right away, and point stdout
+                # at /dev/null so that flushing it on exit doesn't fail again
+                if colorized_lines is not None:
+                    colorized_lines.close()
+                csv_input.close()
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+                exit_error(1)
         else:
             # Show output in pager
+            import_pager()
             pager = Pager()
             pager.application.mouse_support = False
             if hide_title:
@@ -946,5 +3936,23 @@ if __name__ == "__main__":
                 pager_title = ANSI(colored(pager_title_text, COLOR_TITLE_TEXT, attrs=["underline", "dark"]))
                 pager.titlebar_tokens = pager_title
                 pager.display_titlebar = True
-            pager.add_source(FormattedTextSource(ANSI(generate_paged_content(colorized_lines))))
-            pager.run()
+            def make_source(start_row: int, first_column: int) -> CSVPagerSource:
+                name = file_name if start_row == 0 else f"{file_name} (from row {start_row + 1})"
+                # All comment rows come before the first row of the input, only the headers before other rows
+                leading_lines = len(layout.comment_rows) if start_row == 0 else num_header_rows
+                return CSVPagerSource(format_from_row(start_row, first_column), name, 1 if follow else DEFAULT_PAGER_CHUNK_LINES, start_row=start_row, first_column=first_column, leading_lines=leading_lines)
+
+            pager.add_source(make_source(first_row, frozen_columns))
+            # Row positions need the number of rows of the whole input, like --jump (a --fast-start estimate or
+            # input that keeps growing under --follow won't do)
+            if layout.complete and layout.num_rows > 0:
+                add_jump_key_bindings(pager, make_source, layout.num_rows, window_rows)
+            if scroll_columns:
+                add_column_key_bindings(pager, make_source, layout.num_rows, len(layout.max_widths), frozen_columns)
+            # Includes the time spent reading in the pager
+            with profiler.stage("pager"):
+                pager.run()
+    csv_input.close()
+    if isinstance(layout.rows, SortedRows):
+        layout.rows.close()
+    profiler.report(arg_profile_file)